@@ -0,0 +1,404 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCHEDULER = os.path.join(HERE, "scheduler.py")
+
+RULE = "DTSTART:20240101T000000Z RRULE:FREQ=HOURLY;BYMINUTE=15,45"
+
+# The suite's frozen clock; warm checks and fleet ticks step forward one slot at a
+# time from here
+NOW = datetime(2024, 10, 28, 10, 5, tzinfo=timezone.utc)
+SLOT = timedelta(minutes=30)
+
+# Rules of increasing FREQ/BY* complexity, all starting a week before NOW
+COMPLEXITY = {
+    "daily": "FREQ=DAILY",
+    "hourly-byminute": "FREQ=HOURLY;BYMINUTE=0,30",
+    "minutely-interval": "FREQ=MINUTELY;INTERVAL=7",
+    "weekly-byday-byhour": "FREQ=WEEKLY;BYDAY=MO,WE,FR;BYHOUR=9,17;BYMINUTE=0",
+    "monthly-last-friday": "FREQ=MONTHLY;BYDAY=-1FR;BYHOUR=18;BYMINUTE=0",
+    "yearly-leap-day": "FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=29",
+    "bysetpos": "FREQ=MONTHLY;BYDAY=MO,TU,WE,TH,FR;BYSETPOS=-1",
+}
+AGES = {"1d": 1, "30d": 30, "1y": 365, "10y": 3652}
+EXDATE_COUNTS = (0, 10, 100, 1000, 10_000)
+# Share of a minutely rule's occurrences removed by an EXRULE
+EXRULE_DENSITIES = (0, 0.5, 0.9, 0.98)
+FLEET_SIZES = (1, 100, 10_000, 100_000)
+FULL_FLEET_SIZES = FLEET_SIZES + (1_000_000,)
+
+# Lower is better for these results, higher for these; anything else is
+# reported but not compared against a baseline
+LOWER_IS_BETTER = {
+    "import_us",
+    "cli_miss_s",
+    "cli_hit_s",
+    "p50_ms",
+    "p95_ms",
+    "peak_kib",
+}
+HIGHER_IS_BETTER = {"per_s"}
+
+# Modules a plain "import scheduler" must not pull in
+HEAVY_MODULES = (
+    "argparse",
+    "asyncio",
+    "concurrent.futures",
+    "csv",
+    "dateutil.parser",
+    "dateutil.rrule",
+    "dateutil.tz",
+    "numpy",
+    "socket",
+    "tempfile",
+)
+
+
+def import_time_us():
+    # Cumulative -X importtime microseconds of "import scheduler" in a new process
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import scheduler"],
+        cwd=HERE,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == "scheduler":
+            return int(fields[1])
+    raise RuntimeError("scheduler missing from -X importtime output")
+
+
+def heavy_imports():
+    # HEAVY_MODULES loaded as a side effect of importing scheduler
+    code = (
+        "import sys, scheduler; "
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=HERE,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()
+
+
+def cli_seconds(cache_dir):
+    # Wall-clock seconds from process start to exit of one single-rule check
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            SCHEDULER,
+            "--include-rule",
+            RULE,
+            "--cache-dir",
+            cache_dir,
+            "--log-level",
+            "ERROR",
+        ],
+        capture_output=True,
+    )
+    return time.perf_counter() - start
+
+
+def measure_startup(runs):
+    # Medians over runs: import time, and a single check both before the rule's
+    # occurrences are in the on-disk cache (miss) and after (hit)
+    imports, misses, hits = [], [], []
+    for _ in range(runs):
+        imports.append(import_time_us())
+        with tempfile.TemporaryDirectory() as cache_dir:
+            misses.append(cli_seconds(cache_dir))
+            hits.append(cli_seconds(cache_dir))
+    return {
+        "import_us": statistics.median(imports),
+        "cli_miss_s": statistics.median(misses),
+        "cli_hit_s": statistics.median(hits),
+    }
+
+
+def regressions(results, baseline, tolerance, prefix=""):
+    # Descriptions of every result more than tolerance worse than its baseline;
+    # results missing from the baseline are skipped
+    found = []
+    for name, value in results.items():
+        reference = baseline.get(name) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            found += regressions(value, reference, tolerance, f"{prefix}{name}/")
+        elif not reference:
+            continue
+        elif name in LOWER_IS_BETTER and value > reference * (1 + tolerance):
+            found.append(f"{prefix}{name}: {value:.6g} vs baseline {reference:.6g}")
+        elif name in HIGHER_IS_BETTER and value * (1 + tolerance) < reference:
+            found.append(f"{prefix}{name}: {value:.6g} vs baseline {reference:.6g}")
+    return found
+
+
+def compare(results, args):
+    # Regressions against args.baseline, after saving results to args.save
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if not args.baseline:
+        return []
+    with open(args.baseline) as f:
+        return regressions(results, json.load(f), args.tolerance)
+
+
+def startup(args):
+    failures = []
+    heavy = heavy_imports()
+    if heavy:
+        failures.append("import scheduler loads " + ", ".join(heavy))
+
+    results = measure_startup(args.runs)
+    print(json.dumps(results, indent=2))
+    failures += compare(results, args)
+
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of already sorted values
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, items, peak):
+    # Latency percentiles in milliseconds, items per second and peak KiB
+    latencies = sorted(latencies)
+    return {
+        "n": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "per_s": items / sum(latencies) if sum(latencies) else math.inf,
+        "peak_kib": peak / 1024,
+    }
+
+
+def peak_memory(run, times):
+    # Peak traced allocation, in bytes, over times calls of run
+    tracemalloc.start()
+    try:
+        for i in range(times):
+            run(i)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def check_runner(scheduler, rrule_str, exrule_str=None, exdates=(), warm=False):
+    # run(i) performs the i-th check of a case. Cold checks start from an empty
+    # cache like the one-shot CLI; warm checks share one cache like the daemon
+    # and batch modes, and move the clock forward one slot per check.
+    cache = scheduler.RuleCache()
+
+    def run(i):
+        if warm:
+            check_cache, now_utc = cache, NOW + i * SLOT
+        else:
+            check_cache, now_utc = scheduler.RuleCache(horizon=timedelta(0)), NOW
+        status = scheduler.check_rrule_in_slot(
+            rrule_str, exrule_str, exdates, now_utc=now_utc, cache=check_cache
+        )
+        if status not in (0, 1):
+            raise RuntimeError(f"check of {rrule_str!r} returned status {status}")
+
+    return run
+
+
+def check_cases():
+    # (dimension, name, rrule, exrule, exdates) for every single-check case
+    week_ago = (NOW - timedelta(days=7)).strftime("%Y%m%dT%H%M%SZ")
+    for name, rule in COMPLEXITY.items():
+        yield "complexity", name, f"DTSTART:{week_ago} RRULE:{rule}", None, ()
+
+    for name, days in AGES.items():
+        dtstart = (NOW - timedelta(days=days)).strftime("%Y%m%dT%H%M%SZ")
+        rule = f"DTSTART:{dtstart} RRULE:FREQ=HOURLY;BYMINUTE=15"
+        yield "dtstart-age", name, rule, None, ()
+
+    hourly = f"DTSTART:{week_ago} RRULE:FREQ=HOURLY;BYMINUTE=15"
+    for n in EXDATE_COUNTS:
+        # Every other hour from a month before NOW onwards
+        exdates = [
+            NOW.replace(minute=15) + timedelta(hours=2 * i - 720) for i in range(n)
+        ]
+        yield "exdates", str(n), hourly, None, exdates
+
+    minutely = f"DTSTART:{week_ago} RRULE:FREQ=MINUTELY"
+    for density in EXRULE_DENSITIES:
+        minutes = ",".join(str(m) for m in range(round(60 * density)))
+        exrule = f"DTSTART:{week_ago} RRULE:FREQ=MINUTELY;BYMINUTE={minutes}"
+        yield "exrule-density", str(density), minutely, exrule if minutes else None, ()
+
+
+def fleet(size):
+    # A manifest of size jobs cycling through simple and complex rules
+    week_ago = (NOW - timedelta(days=7)).strftime("%Y%m%dT%H%M%SZ")
+    rules = [f"DTSTART:{week_ago} RRULE:{rule}" for rule in COMPLEXITY.values()]
+    rules += [
+        f"DTSTART:{week_ago} RRULE:FREQ=MINUTELY;INTERVAL={interval}"
+        for interval in range(1, 60)
+    ]
+    return [
+        {"job_id": f"job-{i}", "include_rule": rules[i % len(rules)]}
+        for i in range(size)
+    ]
+
+
+def suite(args):
+    # Imported here so the startup benchmark never loads scheduler in-process
+    import scheduler
+
+    logging.getLogger("scheduler").setLevel(logging.ERROR)
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": scheduler.load_numpy() is not None,
+            "now": NOW.isoformat(),
+        },
+    }
+    dimensions = set(args.only or ())
+
+    for dimension, name, rrule_str, exrule_str, exdates in check_cases():
+        if dimensions and dimension not in dimensions:
+            continue
+        for mode in ("cold", "warm"):
+            case = f"{dimension}/{name}/{mode}"
+            run = check_runner(
+                scheduler, rrule_str, exrule_str, exdates, warm=mode == "warm"
+            )
+            latencies = []
+            for i in range(args.checks):
+                start = time.perf_counter()
+                run(i)
+                latencies.append(time.perf_counter() - start)
+            peak = peak_memory(
+                check_runner(
+                    scheduler, rrule_str, exrule_str, exdates, warm=mode == "warm"
+                ),
+                min(args.checks, args.memory_checks),
+            )
+            results[case] = summarize(latencies, args.checks, peak)
+            report(case, results[case])
+
+    if not dimensions or "fleet" in dimensions:
+        for size in FULL_FLEET_SIZES if args.full else FLEET_SIZES:
+            case = f"fleet/{size}"
+            jobs = fleet(size)
+
+            def tick(i):
+                decisions = scheduler.evaluate_jobs(
+                    jobs, NOW + i * SLOT, scheduler.RuleCache()
+                )
+                for _ in decisions:
+                    pass
+
+            latencies = []
+            for i in range(args.ticks):
+                start = time.perf_counter()
+                tick(i)
+                latencies.append(time.perf_counter() - start)
+            results[case] = summarize(
+                latencies, size * args.ticks, peak_memory(tick, 1)
+            )
+            report(case, results[case])
+
+    failures = compare(results, args)
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def report(case, result):
+    print(
+        f"{case:45} p50 {result['p50_ms']:9.3f} ms  p95 {result['p95_ms']:9.3f} ms  "
+        f"p99 {result['p99_ms']:9.3f} ms  {result['per_s']:12.1f}/s  "
+        f"peak {result['peak_kib']:10.1f} KiB",
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for scheduler.py.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser(
+        "startup",
+        help="Measure import time and single-check wall time, failing if heavy "
+        "modules are imported eagerly or a baseline is exceeded.",
+    )
+    command.add_argument("--runs", type=int, default=5)
+    command.add_argument("--baseline", help="JSON results to compare against.")
+    command.add_argument("--save", help="Write the results here as a new baseline.")
+    command.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown over the baseline, as a fraction.",
+    )
+    command.set_defaults(run=startup)
+
+    command = commands.add_parser(
+        "suite",
+        help="Sweep check_rrule_in_slot over rule complexity, DTSTART age, "
+        "exdate count, EXRULE density and fleet size with a frozen clock.",
+    )
+    command.add_argument(
+        "--only",
+        nargs="+",
+        choices=["complexity", "dtstart-age", "exdates", "exrule-density", "fleet"],
+        help="Only run these dimensions.",
+    )
+    command.add_argument(
+        "--checks", type=int, default=200, help="Timed checks per case."
+    )
+    command.add_argument(
+        "--memory-checks",
+        type=int,
+        default=20,
+        help="Checks per case repeated under tracemalloc for peak memory.",
+    )
+    command.add_argument(
+        "--ticks", type=int, default=3, help="Timed ticks per fleet size."
+    )
+    command.add_argument(
+        "--full", action="store_true", help="Include the 1M-job fleet."
+    )
+    command.add_argument("--baseline", help="JSON results to compare against.")
+    command.add_argument("--save", help="Write the results here as a new baseline.")
+    command.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown over the baseline, as a fraction.",
+    )
+    command.set_defaults(run=suite)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,79 +1,2437 @@
-import argparse
+# Only what a one-shot check answered from the occurrence store needs is imported
+# here; dateutil, NumPy, asyncio, argparse and the batch and daemon helpers are
+# imported where they are used, so each cron invocation stays cheap to start.
+import errno
+import hashlib
+import heapq
+import json
 import logging
-from datetime import datetime, timedelta
-from dateutil.rrule import rrulestr, rruleset
-from dateutil.tz import UTC
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
+import math
+import mmap
+import os
+import stat
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
 logger = logging.getLogger(__name__)
 
+UTC = timezone.utc
+
+# dateutil.rrule's frequency numbers, so the module loads without dateutil.rrule
+WEEKLY, DAILY, HOURLY, MINUTELY, SECONDLY = range(2, 7)
+
+# NumPy for the batch fast path, imported on first use; None if it is missing
+NOT_LOADED = object()
+np = NOT_LOADED
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+NAIVE_EPOCH = datetime(1970, 1, 1)
+
+# Longest request line the daemon accepts, enough for tens of thousands of exdates
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+# Default span of occurrences materialized ahead of now for each compiled rule
+INDEX_HORIZON = timedelta(days=7)
+
+# Default span of slots a SlotIndex keeps job IDs for, from the current slot on
+SLOT_WINDOW = timedelta(hours=6)
+
+# Local wall-clock seconds either side of a lookup covered by a zone's transition
+# table, comfortably more than the index horizon; lookups outside the window
+# retabulate around them
+ZONE_TABLE_SPAN = 400 * 86400
+
+# Wall-clock seconds either side of a transition checked for offset changes the
+# transition list does not account for
+ZONE_CHECK_MARGIN = 2 * 3600
+
+# Transition tables of the DST zones seen so far, by id() of the dateutil zone
+zone_tables = {}
+
+# Status returned by check_rrule_in_slot when a rule needs more work than its
+# evaluation budget allows (0 = in slot, 1 = not in slot, -1 = error; 2 is left to
+# argparse usage errors)
+BUDGET_EXCEEDED = 3
+
+# Default per-evaluation budget: occurrences generated, including excluded ones,
+# and wall-clock seconds spent before the next occurrence is found
+MAX_ITERATIONS = 1_000_000
+MAX_SECONDS = 2.0
+
+# Longest possible length of each month, for spotting impossible BYMONTHDAYs
+MONTH_DAYS = {1: 31, 2: 29, 3: 31, 4: 30, 5: 31, 6: 30}
+MONTH_DAYS.update({7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31})
+
+# Default scheduling slot: 30 minutes wide, aligned to the Unix epoch (and so to
+# the top of the hour).
+# Slot n covers [n * width + offset, (n + 1) * width + offset) in epoch seconds.
+SLOT_WIDTH = timedelta(minutes=30)
+SLOT_OFFSET = timedelta(0)
+
+# Frequencies the batch fast path evaluates arithmetically, and the number of
+# jobs it evaluates at once
+SIMPLE_FREQS = {MINUTELY: 60, HOURLY: 3600, DAILY: 86400}
+BATCH_SIZE = 4096
+
+# Stands in for "no COUNT" and "no UNTIL" in the fast path's int64 columns
+UNBOUNDED = 2**63 - 1
+
+
+def load_numpy():
+    global np
+    if np is NOT_LOADED:
+        try:
+            import numpy as np
+        except ImportError:  # the batch fast path falls back to plain Python
+            np = None
+    return np
+
+
+# Upper bounds, in seconds, of the phase duration histogram buckets
+METRIC_BUCKETS = (1e-05, 5e-05, 0.0001, 0.0005, 0.001, 0.005)
+METRIC_BUCKETS += (0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def from_epoch(ts):
+    # UTC datetime for epoch seconds, without going through datetime class methods
+    return EPOCH + timedelta(seconds=ts)
+
+
+class Histogram:
+    # Fixed-bucket histogram of durations in seconds; counts[i] holds observations
+    # up to buckets[i], and the last entry everything above the largest bucket
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        # Add the observations of a histogram with the same buckets
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative(self):
+        # (upper bound, observations up to it) pairs as Prometheus reports them
+        total = 0
+        bounds = [*self.buckets, math.inf]
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    # Per-phase duration histograms and event counters for the evaluation hot
+    # path, exported as a JSON stats dump or in the Prometheus text format
+    # (for the node_exporter textfile collector)
+
+    def __init__(self, buckets=METRIC_BUCKETS, prefix="slot_scheduler"):
+        self.buckets = buckets
+        self.prefix = prefix
+        self.phases = {}
+        self.counters = defaultdict(int)
+
+    def observe(self, phase, seconds):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def merge(self, other):
+        # Add the phases and counters recorded by another Metrics, for instance
+        # one from a worker process
+        for phase, histogram in other.phases.items():
+            if phase in self.phases:
+                self.phases[phase].merge(histogram)
+            else:
+                self.phases[phase] = histogram
+        for name, n in other.counters.items():
+            self.counters[name] += n
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def to_dict(self):
+        return {
+            "phases": {
+                phase: {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": {
+                        "+Inf" if bound == math.inf else repr(bound): count
+                        for bound, count in histogram.cumulative()
+                    },
+                }
+                for phase, histogram in sorted(self.phases.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def to_prometheus(self):
+        name = f"{self.prefix}_phase_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each phase of a slot check.",
+            f"# TYPE {name} histogram",
+        ]
+        for phase, histogram in sorted(self.phases.items()):
+            for bound, count in histogram.cumulative():
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f'{name}_bucket{{phase="{phase}",le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{phase="{phase}"}} {histogram.sum!r}')
+            lines.append(f'{name}_count{{phase="{phase}"}} {histogram.count}')
+        for counter, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{counter}_total counter")
+            lines.append(f"{self.prefix}_{counter}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.to_dict(), indent=2) + "\n")
+
+    def write_prometheus(self, path):
+        _write_atomic(path, self.to_prometheus())
+
+
+def _write_atomic(path, text):
+    # Replace path in one step so scrapers never read a half-written file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# Process-wide metrics, or None while instrumentation is disabled
+metrics = None
+
+# Shared no-op context for timed() while metrics are disabled
+_NO_TIMER = nullcontext()
+
+
+def enable_metrics(buckets=METRIC_BUCKETS):
+    global metrics
+    metrics = Metrics(buckets)
+    return metrics
+
+
+def disable_metrics():
+    global metrics
+    metrics = None
+
+
+def export_metrics(json_path=None, prom_path=None):
+    # Write the current metrics to whichever of the given files are set
+    if metrics is None:
+        return
+    if json_path:
+        metrics.write_json(json_path)
+    if prom_path:
+        metrics.write_prometheus(prom_path)
+
+
+def timed(phase):
+    # Context manager timing a phase into the metrics, if they are enabled
+    return _NO_TIMER if metrics is None else metrics.timer(phase)
 
-def check_rrule_in_slot(rrule_str, exrule_str=None, exdates=None):
+
+def count(name, n=1):
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+def slot_seconds(slot_width=SLOT_WIDTH, slot_offset=SLOT_OFFSET):
+    # Slot width and offset in whole seconds; ValueError unless the width is a
+    # positive whole number of seconds and the offset a whole number of seconds
+    width, rest = divmod(slot_width, timedelta(seconds=1))
+    if rest or width < 1:
+        raise ValueError(f"slot width must be whole seconds, at least 1: {slot_width}")
+    offset, rest = divmod(slot_offset, timedelta(seconds=1))
+    if rest:
+        raise ValueError(f"slot offset must be whole seconds: {slot_offset}")
+    return width, offset
+
+
+def slot_number(ts, slot_width=SLOT_WIDTH, slot_offset=SLOT_OFFSET):
+    # Number of the slot containing the given epoch seconds
+    width, offset = slot_seconds(slot_width, slot_offset)
+    return (math.floor(ts) - offset) // width
+
+
+def slot_bounds(now_utc, slot_width=SLOT_WIDTH, slot_offset=SLOT_OFFSET):
+    # Round down the given UTC time to the start of its slot
+    width, offset = slot_seconds(slot_width, slot_offset)
+    start = (math.floor(now_utc.timestamp()) - offset) // width * width + offset
+    return from_epoch(start), from_epoch(start + width)
+
+
+def normalize_exdates(exdates):
+    # Ensure every exdate is in UTC and return them as a sorted, hashable tuple
+    normalized = set()
+    for exdate in exdates or ():
+        if exdate.tzinfo is None:
+            exdate = exdate.replace(tzinfo=UTC)
+        else:
+            exdate = exdate.astimezone(UTC)
+        normalized.add(exdate)
+    return tuple(sorted(normalized))
+
+
+def exdate_timestamps(exdates):
+    # UTC epoch seconds of the given exdates, for hashed exclusion lookups
+    return frozenset(exdate.timestamp() for exdate in normalize_exdates(exdates))
+
+
+def _utc(dt):
+    # An aware UTC datetime, treating naive ones as UTC like naive exdates
+    return dt.replace(tzinfo=UTC) if dt.tzinfo is None else dt.astimezone(UTC)
+
+
+def _ical_value(value, params):
+    # A DATE or DATE-TIME property value as (datetime, whether it is a date)
+    from dateutil.parser import isoparse
+    from dateutil.tz import gettz
+
+    value = value.strip()
+    if params.get("VALUE", "").upper() == "DATE" or len(value) == 8:
+        return datetime.strptime(value, "%Y%m%d"), True
+    dt = isoparse(value)
+    if dt.tzinfo is None and "TZID" in params:
+        dt = dt.replace(tzinfo=gettz(params["TZID"]))
+    return dt, False
+
+
+def _ical_duration(value):
+    # An iCalendar DURATION such as P1D or PT2H30M as a timedelta
+    import re
+
+    match = re.fullmatch(
+        r"\+?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?",
+        value.strip().upper(),
+    )
+    if not match or not any(match.groups()):
+        raise ValueError(f"unsupported DURATION {value!r}")
+    weeks, days, hours, minutes, seconds = (int(n or 0) for n in match.groups())
+    return timedelta(
+        weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds
+    )
+
+
+def _ical_exclusions(lines):
+    # Yield what an iCalendar file excludes as (start, end) datetimes, end being
+    # None for a single instant: every EXDATE value, and every VEVENT from its
+    # DTSTART to its DTEND or DURATION. Dates (VALUE=DATE, as all-day events and
+    # holidays use) cover the whole day, and an event with neither end covers
+    # its start day if that is a date, else only its start. Floating times and
+    # dates are treated as UTC like other naive exdates.
+    unfolded = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and unfolded:
+            unfolded[-1] += line[1:]
+        elif line:
+            unfolded.append(line)
+
+    event = None
+    for line in unfolded:
+        name, _, value = line.partition(":")
+        name, *params = name.split(";")
+        name = name.upper()
+        params = dict(param.split("=", 1) for param in params if "=" in param)
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            event = {}
+        elif name == "END" and value.upper() == "VEVENT":
+            if event and "DTSTART" in event:
+                start, is_date = _ical_value(*event["DTSTART"])
+                if "DTEND" in event:
+                    end = _ical_value(*event["DTEND"])[0]
+                elif "DURATION" in event:
+                    end = start + _ical_duration(event["DURATION"][0])
+                else:
+                    end = start + timedelta(days=1) if is_date else None
+                yield start, end
+            event = None
+        elif name == "EXDATE":
+            for dt_str in value.split(","):
+                dt, is_date = _ical_value(dt_str, params)
+                yield dt, dt + timedelta(days=1) if is_date else None
+        elif event is not None and name in ("DTSTART", "DTEND", "DURATION"):
+            event[name] = (value, params)
+
+
+class ExclusionCalendar:
+    # A named set of excluded instants and [start, end) ranges, shared by every
+    # job that references it instead of being copied per job. Instants are held
+    # as hashed UTC epoch seconds, and ranges merged into sorted start and end
+    # arrays searched with bisect.
+
+    def __init__(self, name, exdates=(), ranges=()):
+        self.name = name
+        self.timestamps = exdate_timestamps(exdates)
+        self.starts = array("d")
+        self.ends = array("d")
+        for start, end in sorted(
+            (_utc(start).timestamp(), _utc(end).timestamp()) for start, end in ranges
+        ):
+            if end <= start:
+                continue
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+        # Identifies the calendar's contents in on-disk cache keys
+        contents = sorted(self.timestamps)
+        if self.starts:
+            contents = (contents, list(zip(self.starts, self.ends)))
+        self.digest = hashlib.blake2b(
+            repr(contents).encode(), digest_size=16
+        ).hexdigest()
+
+    def __contains__(self, ts):
+        if ts in self.timestamps:
+            return True
+        i = bisect_right(self.starts, ts) - 1
+        return i >= 0 and ts < self.ends[i]
+
+    def __len__(self):
+        return len(self.timestamps) + len(self.starts)
+
+    def __repr__(self):
+        return (
+            f"ExclusionCalendar({self.name!r}, {len(self.timestamps)} dates, "
+            f"{len(self.starts)} ranges)"
+        )
+
+    @classmethod
+    def from_file(cls, name, path):
+        # Either an iCalendar file (EXDATEs and VEVENTs, see _ical_exclusions) or
+        # a plain list of ISO datetimes, one per line, with "#" comments; a line
+        # with only a date excludes that whole day (in UTC)
+        from dateutil.parser import isoparse
+
+        with open(path) as f:
+            lines = f.readlines()
+        exdates = []
+        ranges = []
+        if any(line.strip().upper() == "BEGIN:VCALENDAR" for line in lines[:5]):
+            for start, end in _ical_exclusions(lines):
+                if end is None:
+                    exdates.append(start)
+                else:
+                    ranges.append((start, end))
+            return cls(name, exdates, ranges)
+        for line in lines:
+            line = line.split("#", 1)[0].strip()
+            if len(line) == 10:
+                day = datetime.strptime(line, "%Y-%m-%d")
+                ranges.append((day, day + timedelta(days=1)))
+            elif line:
+                exdates.append(isoparse(line))
+        return cls(name, exdates, ranges)
+
+
+# Exclusion calendars loaded by name, for manifests and daemon requests to reference
+calendars = {}
+
+
+def load_calendar(name, path):
+    calendars[name] = calendar = ExclusionCalendar.from_file(name, path)
+    logger.info(
+        "Loaded exclusion calendar %s with %s dates and %s ranges",
+        name,
+        len(calendar.timestamps),
+        len(calendar.starts),
+    )
+    return calendar
+
+
+def resolve_calendars(names):
+    # Calendars registered under the given names, in a stable order
     try:
-        # Get the current UTC time and log it
-        now_utc = datetime.now(UTC)
-        logger.info(f"Current UTC time: {now_utc}")
+        return tuple(calendars[name] for name in sorted(set(names or ())))
+    except KeyError as e:
+        raise ValueError(f"unknown exclusion calendar {e}") from None
+
+
+def compile_rules(rrule_str, exrule_str=None, exdates=None):
+    from dateutil.rrule import rrulestr, rruleset
+
+    # Create rruleset and add the inclusion rule
+    rules = rruleset()
+    rules.rrule(rrulestr(rrule_str, forceset=True))
+    logger.info("Inclusion rule applied: %s", rrule_str)
+
+    # Add exclusion rule if provided
+    if exrule_str:
+        rules.exrule(rrulestr(exrule_str, forceset=True))
+        logger.info("Exclusion rule applied: %s", exrule_str)
+
+    # Add exclusion dates if provided
+    for exdate in normalize_exdates(exdates):
+        rules.exdate(exdate)
+        logger.info("Exclusion date added: %s", exdate)
+
+    return rules
+
+
+# Frequencies whose periods are a fixed wall-clock length, so DTSTART can be moved
+# forward by whole periods without changing the rule's phase
+FIXED_PERIODS = {
+    SECONDLY: timedelta(seconds=1),
+    MINUTELY: timedelta(minutes=1),
+    HOURLY: timedelta(hours=1),
+    DAILY: timedelta(days=1),
+    WEEKLY: timedelta(weeks=1),
+}
 
-        # Create rruleset and add the inclusion rule
-        rules = rruleset()
-        rules.rrule(rrulestr(rrule_str, forceset=True))
-        logger.info(f"Inclusion rule applied: {rrule_str}")
+# BY* parts that expand every period of a frequency into the same number of
+# occurrences, so a COUNT can be fast-forwarded by whole periods
+FIXED_EXPANSIONS = {
+    SECONDLY: (),
+    MINUTELY: ("bysecond",),
+    HOURLY: ("byminute", "bysecond"),
+    DAILY: ("byhour", "byminute", "bysecond"),
+}
 
-        # Add exclusion rule if provided
-        if exrule_str:
-            rules.exrule(rrulestr(exrule_str, forceset=True))
-            logger.info(f"Exclusion rule applied: {exrule_str}")
+# How far "now" may move past an anchored ruleset before it is anchored again
+REANCHOR_AFTER = timedelta(hours=1)
 
-        # Add exclusion dates if provided
+# How far before now a fast-forwarded DTSTART is placed, in wall-clock time; this
+# covers wall clocks repeating or skipping around DST transitions
+FAST_FORWARD_MARGIN = timedelta(hours=3)
+
+
+class EmptyRuleError(ValueError):
+    pass
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+def _yearday_months(yearday):
+    # Months a BYYEARDAY value can fall in, over leap and common years
+    months = set()
+    for year in (2023, 2024):
+        days = 366 if year == 2024 else 365
+        day = yearday if yearday > 0 else days + yearday + 1
+        if 1 <= day <= days:
+            months.add((datetime(year, 1, 1) + timedelta(days=day - 1)).month)
+    return months
+
+
+def _weekno_months(weekno, wkst):
+    # Months a BYWEEKNO value can fall in, over every weekday Jan 1 can fall on
+    # in leap and common years. Week 1 is the first week starting on wkst with
+    # at least four days in the year.
+    def week_one(year):
+        jan4 = datetime(year, 1, 4)
+        return jan4 - timedelta(days=(jan4.weekday() - wkst) % 7)
+
+    months = set()
+    for year in range(2020, 2048):
+        first = week_one(year)
+        weeks = (week_one(year + 1) - first).days // 7
+        week = weekno if weekno > 0 else weeks + weekno + 1
+        if 1 <= week <= weeks:
+            start = first + timedelta(weeks=week - 1)
+            months.update((start + timedelta(days=i)).month for i in range(7))
+    return months
+
+
+def empty_rule_reason(rule):
+    # Why a dateutil rrule can provably never produce an occurrence, or None.
+    # dateutil searches such rules up to year 9999 without yielding anything, so
+    # they must be rejected before they are evaluated.
+    if rule._interval < 1:
+        return "INTERVAL must be at least 1"
+    if rule._count == 0:
+        return "COUNT=0"
+    try:
+        if rule._until is not None and rule._until < rule._dtstart:
+            return "UNTIL is before DTSTART"
+    except TypeError:
+        pass
+
+    months = rule._bymonth or tuple(MONTH_DAYS)
+    monthdays = rule._bymonthday or ()
+    nmonthdays = rule._bynmonthday or ()
+    if monthdays or nmonthdays:
+        months = [
+            month
+            for month in months
+            if any(day <= MONTH_DAYS[month] for day in monthdays)
+            or any(-day <= MONTH_DAYS[month] for day in nmonthdays)
+        ]
+        if not months:
+            return "no BYMONTHDAY exists in any allowed month"
+    if rule._byyearday:
+        if not any(set(months) & _yearday_months(day) for day in rule._byyearday):
+            return "no BYYEARDAY falls in an allowed month"
+    if rule._byweekno:
+        if not any(
+            set(months) & _weekno_months(week, rule._wkst) for week in rule._byweekno
+        ):
+            return "no BYWEEKNO falls in an allowed month"
+    return None
+
+
+def check_not_empty(rules):
+    # Raise EmptyRuleError if any inclusion rule can never match. Exclusion rules
+    # that can never match exclude nothing, so they are dropped instead.
+    from dateutil.rrule import rruleset
+
+    for rule in rules._rrule:
+        if isinstance(rule, rruleset):
+            check_not_empty(rule)
+            continue
+        reason = empty_rule_reason(rule)
+        if reason:
+            raise EmptyRuleError(f"rule can never match: {reason}")
+    rules._exrule = [rule for rule in rules._exrule if not drop_empty(rule)]
+
+
+def drop_empty(rules):
+    # Remove the rules of an exclusion that can never match; True if nothing that
+    # could match is left
+    from dateutil.rrule import rruleset
+
+    if not isinstance(rules, rruleset):
+        return empty_rule_reason(rules) is not None
+    rules._rrule = [rule for rule in rules._rrule if not drop_empty(rule)]
+    rules._exrule = [rule for rule in rules._exrule if not drop_empty(rule)]
+    return not rules._rrule and not rules._rdate
+
+
+class EvaluationBudget:
+    # Caps the occurrences generated (excluded ones included) and the time spent
+    # by one evaluation; exceeding either raises BudgetExceeded. Occurrences are
+    # only charged between start() and stop(). until, a UTC datetime or None, is
+    # the end of the range being evaluated, past which rules stop their walk.
+
+    def __init__(self, max_iterations=MAX_ITERATIONS, max_seconds=MAX_SECONDS):
+        self.max_iterations = max_iterations
+        self.max_seconds = max_seconds
+        self.iterations = 0
+        self.deadline = None
+        self.until = None
+
+    def start(self):
+        self.iterations = 0
+        self.deadline = time.monotonic() + self.max_seconds
+
+    def stop(self):
+        self.deadline = None
+
+    def tick(self):
+        if self.deadline is None:
+            return
+        self.iterations += 1
+        if self.iterations > self.max_iterations:
+            raise BudgetExceeded(f"more than {self.max_iterations} iterations")
+        self.check_time()
+
+    def check_time(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded(f"more than {self.max_seconds}s")
+
+
+class WalkEnd(Exception):
+    # Raised inside dateutil to end a rule's walk past its budget's until
+    pass
+
+
+class BudgetedRule:
+    # Iterates a dateutil rule inside a ruleset, charging each occurrence it
+    # generates to a budget, including ones the ruleset then excludes. dateutil
+    # may walk periods without generating anything (up to year 9999 for a rule
+    # that never matches), so every period it walks also checks the budget's
+    # time and ends the walk once the period starts after the budget's until.
+
+    def __init__(self, rule, budget):
+        self.rule = rule
+        self.budget = budget
+
+    def __iter__(self):
+        tick = self.budget.tick
+        until = self.budget.until
+        limit = None
+        if until is not None:
+            tzinfo = self.rule._dtstart.tzinfo
+            local = until.astimezone(tzinfo) if tzinfo is not None else until
+            limit = local.timetuple()[:3]
+        self.rule._walk = (self.budget, limit)
+        try:
+            for occurrence in self.rule:
+                tick()
+                yield occurrence
+        except WalkEnd:
+            return
+        finally:
+            self.rule._walk = None
+
+
+def bound_walks():
+    # Make dateutil call back once per period it walks, for rules being iterated
+    # by a BudgetedRule. dateutil builds the period masks through the module's
+    # _iterinfo, so that is replaced by a subclass checking the rule's _walk.
+    import dateutil.rrule
+
+    if getattr(dateutil.rrule._iterinfo, "bounded", False):
+        return
+
+    class BoundedIterInfo(dateutil.rrule._iterinfo):
+        bounded = True
+
+        def check(self, period_start):
+            walk = getattr(self.rrule, "_walk", None)
+            if walk is not None:
+                budget, limit = walk
+                budget.check_time()
+                if limit is not None and period_start > limit:
+                    raise WalkEnd
+
+        def ydayset(self, year, month, day):
+            self.check((year, 1, 1))
+            return super().ydayset(year, month, day)
+
+        def mdayset(self, year, month, day):
+            self.check((year, month, 1))
+            return super().mdayset(year, month, day)
+
+        def wdayset(self, year, month, day):
+            self.check((year, month, day))
+            return super().wdayset(year, month, day)
+
+        def ddayset(self, year, month, day):
+            self.check((year, month, day))
+            return super().ddayset(year, month, day)
+
+    dateutil.rrule._iterinfo = BoundedIterInfo
+
+
+def fast_forward(rule, now_utc):
+    # Move DTSTART to shortly before now_utc by a whole number of INTERVAL periods,
+    # so after() no longer walks every occurrence since the original DTSTART.
+    # dateutil iterates in wall-clock time, so the shift is done on wall-clock fields
+    # and keeps FAST_FORWARD_MARGIN for UTC offset changes around now.
+    from dateutil.rrule import rruleset
+
+    if isinstance(rule, rruleset):
+        return fast_forward_ruleset(rule, now_utc)
+
+    period = FIXED_PERIODS.get(rule._freq)
+    dtstart = rule._dtstart
+    if period is None or dtstart.tzinfo is None:
+        return rule
+    period *= rule._interval
+
+    now_local = now_utc.astimezone(dtstart.tzinfo).replace(tzinfo=None)
+    elapsed = now_local - dtstart.replace(tzinfo=None) - FAST_FORWARD_MARGIN
+    periods = elapsed // period
+    if periods <= 0:
+        return rule
+
+    count = rule._count
+    if count is not None:
+        per_period = occurrences_per_period(rule)
+        if per_period is None:
+            return rule
+        # Keep at least the last occurrence so the rule is not emptied
+        periods = min(periods, (count - 1) // per_period)
+        if periods <= 0:
+            return rule
+        count -= periods * per_period
+
+    return rule.replace(dtstart=dtstart + periods * period, count=count)
+
+
+def occurrences_per_period(rule):
+    # Occurrences every period of a rule yields, or None if its BY* parts make the
+    # number vary. Occurrences before DTSTART in its own period are dropped, but
+    # the shifted DTSTART drops the same ones, so skipping whole periods still
+    # uses up exactly this many occurrences of COUNT per period.
+    expansions = FIXED_EXPANSIONS.get(rule._freq)
+    if expansions is None or any(
+        value is not None and key not in expansions
+        for key, value in rule._original_rule.items()
+    ):
+        return None
+    per_period = 1
+    for key in expansions:
+        per_period *= len(getattr(rule, "_" + key))
+    return per_period
+
+
+def fast_forward_ruleset(rules, now_utc, budget=None):
+    # Rebuild a ruleset with every rrule and exrule fast-forwarded, and charged to
+    # budget if one is given; rdates and exdates are shared with the original
+    # rather than copied
+    from dateutil.rrule import rruleset
+
+    if budget is not None:
+        bound_walks()
+
+    def anchor(rule):
+        if isinstance(rule, rruleset):
+            return fast_forward_ruleset(rule, now_utc, budget)
+        rule = fast_forward(rule, now_utc)
+        return BudgetedRule(rule, budget) if budget is not None else rule
+
+    anchored = rruleset()
+    for rule in rules._rrule:
+        anchored.rrule(anchor(rule))
+    for rule in rules._exrule:
+        anchored.exrule(anchor(rule))
+    anchored._rdate = rules._rdate
+    anchored._exdate = rules._exdate
+    return anchored
+
+
+class OccurrenceIndex:
+    # Occurrences of a compiled rule over [start, end) as sorted UTC epoch seconds,
+    # so "is there an occurrence in this slot" is a binary search. The window is
+    # extended incrementally once less than half of the horizon is left ahead of
+    # now, and rebuilt only when now leaves it.
+
+    def __init__(self, compiled, horizon=INDEX_HORIZON):
+        self.compiled = compiled
+        self.horizon = int(horizon.total_seconds())
+        self.start = None
+        self.end = None
+        self.occurrences = array("q")
+
+    def _materialize(self, start, end, now_utc, until, found=False):
+        # Occurrences in [start, end) and the point they are known up to. The whole
+        # walk is charged to one evaluation budget; when it runs out past until, or
+        # after the next occurrence at or after now is known (found says the index
+        # already holds one), the window is cut short at the last occurrence found
+        # instead of failing.
+        occurrences = array("q")
+        budget = self.compiled.budget
+        budget.start()
+        try:
+            occurrences_from = self.compiled.occurrences(
+                from_epoch(start), now_utc, False, end
+            )
+            for ts in occurrences_from:
+                if ts >= end:
+                    break
+                occurrences.append(int(ts))
+        except BudgetExceeded:
+            end = occurrences[-1] + 1 if occurrences else start
+            found = found or end > math.ceil(now_utc.timestamp())
+            if end < until and not found:
+                raise
+        finally:
+            budget.stop()
+        return occurrences, end
+
+    def _has_next(self, now_utc):
+        # Whether the index holds an occurrence at or after now_utc
+        occurrences = self.occurrences
+        return bool(occurrences) and occurrences[-1] >= math.ceil(now_utc.timestamp())
+
+    def ensure(self, now_utc, until):
+        # Make sure the index covers [now_utc, until) with until in epoch seconds
+        now_ts = math.floor(now_utc.timestamp())
+        end = max(until, now_ts + self.horizon)
+        if self.start is None or not self.start <= now_ts <= self.end:
+            with timed("materialize"):
+                self.occurrences, end = self._materialize(now_ts, end, now_utc, until)
+            self.start = now_ts
+        elif until > self.end or self.end - now_ts < self.horizon // 2:
+            with timed("materialize"):
+                occurrences, end = self._materialize(
+                    self.end, end, now_utc, until, self._has_next(now_utc)
+                )
+                self.occurrences.extend(occurrences)
+            # Drop occurrences that are already in the past
+            del self.occurrences[: bisect_left(self.occurrences, now_ts)]
+            self.start = now_ts
+        else:
+            return
+        self.end = end
+
+    def between(self, now_utc, start, end):
+        # Occurrences in [start, end) epoch seconds, with the index anchored at
+        # now_utc; BudgetExceeded if the budget ran out before end
+        self.ensure(now_utc, end)
+        if self.end < end:
+            raise BudgetExceeded(f"occurrences only known up to {from_epoch(self.end)}")
+        occurrences = self.occurrences
+        return occurrences[
+            bisect_left(occurrences, start) : bisect_left(occurrences, end)
+        ]
+
+    def next_after(self, now_utc, until):
+        # First occurrence at or after now_utc and before until, in epoch seconds
+        self.ensure(now_utc, until)
+        with timed("lookup"):
+            i = bisect_left(self.occurrences, math.ceil(now_utc.timestamp()))
+            if i < len(self.occurrences) and self.occurrences[i] < until:
+                return self.occurrences[i]
+            return None
+
+
+class CompiledRule:
+    # A compiled ruleset plus a copy fast-forwarded to just before "now". The copy
+    # is anchored again once now moves REANCHOR_AFTER past it, or goes backwards.
+    # Exdates and exclusion calendars are applied as hashed epoch lookups rather
+    # than inside the ruleset. Lookups go through an OccurrenceIndex over the
+    # given horizon, and each materialization is bounded by budget. Inclusion
+    # rules that provably never match are rejected with EmptyRuleError.
+
+    def __init__(
+        self, rules, horizon=INDEX_HORIZON, exdates=(), calendars=(), budget=None
+    ):
+        check_not_empty(rules)
+        self.rules = rules
+        self.exdates = exdate_timestamps(exdates)
+        self.calendars = tuple(calendars)
+        self.budget = budget if budget is not None else EvaluationBudget()
+        self._anchor = None
+        self._anchored = rules
+        self.index = OccurrenceIndex(self, horizon)
+
+    def ruleset_at(self, now_utc):
+        if self._anchor is None or not (
+            self._anchor <= now_utc < self._anchor + REANCHOR_AFTER
+        ):
+            self._anchored = fast_forward_ruleset(self.rules, now_utc, self.budget)
+            self._anchor = now_utc
+        return self._anchored
+
+    def occurrences(self, start, now_utc, restart=True, end=None):
+        # Epoch seconds of the non-excluded occurrences at or after start, and, if
+        # end (epoch seconds) is given, at least those before it. With restart the
+        # budget restarts for every occurrence found; otherwise the caller starts
+        # and stops it around the whole walk. With metrics enabled, the time spent
+        # converting occurrences to UTC is recorded as the "tz" phase.
+        exdates = self.exdates
+        calendars = self.calendars
+        rules = self.ruleset_at(now_utc)
+        self.budget.until = from_epoch(end) if end is not None else None
+        recorder = metrics
+        iterated = 0
+        tz_seconds = 0.0
+        if restart:
+            self.budget.start()
+        try:
+            for occurrence in rules.xafter(start, inc=True):
+                if recorder is None:
+                    ts = utc_timestamp(occurrence)
+                else:
+                    iterated += 1
+                    tz_start = time.perf_counter()
+                    ts = utc_timestamp(occurrence)
+                    tz_seconds += time.perf_counter() - tz_start
+                if ts in exdates or any(ts in calendar for calendar in calendars):
+                    continue
+                yield ts
+                if restart:
+                    self.budget.start()
+        finally:
+            if restart:
+                self.budget.stop()
+            if recorder is not None:
+                recorder.observe("tz", tz_seconds)
+                recorder.count("occurrences_iterated", iterated)
+
+
+class RuleCache:
+    # Bounded LRU of compiled rules keyed by (include rule, exclude rule, exdates,
+    # exclusion calendars), so long-lived callers skip parsing and rruleset
+    # construction for repeated rules. A maxsize of 0 disables caching; horizon and
+    # the budget limits are passed on to each compiled rule.
+
+    def __init__(
+        self,
+        maxsize=4096,
+        horizon=INDEX_HORIZON,
+        max_iterations=MAX_ITERATIONS,
+        max_seconds=MAX_SECONDS,
+    ):
+        self.maxsize = maxsize
+        self.horizon = horizon
+        self.max_iterations = max_iterations
+        self.max_seconds = max_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, rrule_str, exrule_str=None, exdates=None, calendars=()):
+        with timed("exdates"):
+            key = (
+                rrule_str,
+                exrule_str or None,
+                normalize_exdates(exdates),
+                tuple(calendars),
+            )
+        compiled = self._entries.get(key)
+        if compiled is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            count("cache_hits")
+            return compiled
+
+        self.misses += 1
+        count("cache_misses")
+        with timed("parse"):
+            compiled = CompiledRule(
+                compile_rules(rrule_str, exrule_str),
+                self.horizon,
+                key[2],
+                key[3],
+                EvaluationBudget(self.max_iterations, self.max_seconds),
+            )
+        if key[2]:
+            logger.info("Exclusion dates added: %s", len(key[2]))
+        if self.maxsize > 0:
+            self._entries[key] = compiled
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return compiled
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SlotIndex:
+    # Inverted index from slot number to the IDs of jobs with an occurrence in that
+    # slot, over a rolling window that starts at the current slot. A job is due in
+    # a slot exactly when check_rrule_in_slot would schedule it at the slot start.
+    # The window is extended once less than half of it is left, and jobs are
+    # re-indexed individually when they are added, changed or removed. Each job's
+    # slots are only held in the slot sets; removing a job works them out again
+    # from its occurrences.
+
+    def __init__(
+        self, window=SLOT_WINDOW, slot_width=SLOT_WIDTH, slot_offset=SLOT_OFFSET
+    ):
+        self.slot_width = slot_width
+        self.slot_offset = slot_offset
+        self._width, self._offset = slot_seconds(slot_width, slot_offset)
+        self.window = max(1, int(window.total_seconds()) // self._width)
+        self.start = None
+        self.end = None
+        self._slots = defaultdict(set)
+        self._jobs = {}
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, job_id):
+        return job_id in self._jobs
+
+    def _job_slots(self, occurrences, start, end):
+        # Slots in [start, end) in which the given occurrences fire
+        start_ts = start * self._width + self._offset
+        end_ts = end * self._width + self._offset
+        return {
+            (ts - self._offset) // self._width
+            for ts in occurrences.between(from_epoch(start_ts), start_ts, end_ts)
+        }
+
+    def _index_jobs(self, start, end):
+        # A job that fails to index, for instance over its evaluation budget, is
+        # left out of these slots instead of failing the whole window
+        for job_id, occurrences in self._jobs.items():
+            try:
+                for slot in self._job_slots(occurrences, start, end):
+                    self._slots[slot].add(job_id)
+            except Exception as e:
+                logger.error("Error: could not index job %s: %s", job_id, e)
+
+    def advance(self, now_utc):
+        # Move the window to the slot containing now_utc, indexing every job over
+        # the slots it newly covers, and return that slot
+        slot = slot_number(now_utc.timestamp(), self.slot_width, self.slot_offset)
+        if self.start is None or not self.start <= slot < self.end:
+            # Rebuild the whole window around the new slot
+            self._slots.clear()
+            self.start, self.end = slot, slot + self.window
+            self._index_jobs(self.start, self.end)
+        elif self.end - slot < self.window // 2:
+            # Forget past slots and index only the newly covered ones
+            for past in range(self.start, slot):
+                self._slots.pop(past, None)
+            end = slot + self.window
+            self._index_jobs(self.end, end)
+            self.start, self.end = slot, end
+        return slot
+
+    def add(self, job_id, compiled):
+        # Register a job, or replace its rule if it is already registered. compiled
+        # is a CompiledRule, or a JobRecord that filters a shared one. The job is
+        # indexed before anything is replaced, so if that fails any previous
+        # registration is kept.
+        occurrences = compiled.index if isinstance(compiled, CompiledRule) else compiled
+        slots = ()
+        if self.start is not None:
+            slots = self._job_slots(occurrences, self.start, self.end)
+        self.remove(job_id)
+        self._jobs[job_id] = occurrences
+        for slot in slots:
+            self._slots[slot].add(job_id)
+
+    def remove(self, job_id):
+        occurrences = self._jobs.pop(job_id, None)
+        if occurrences is None:
+            return False
+        if self.start is not None:
+            try:
+                slots = self._job_slots(occurrences, self.start, self.end)
+            except Exception:
+                # Over its budget, so look in every slot of the window instead
+                slots = range(self.start, self.end)
+            for slot in slots:
+                job_ids = self._slots.get(slot)
+                if job_ids is not None:
+                    job_ids.discard(job_id)
+        return True
+
+    def footprint(self):
+        # Approximate bytes held by the index: the slot sets dominate, at one
+        # entry per job and slot it fires in within the window
+        size = sys.getsizeof(self._jobs) + sys.getsizeof(self._slots)
+        for job_ids in self._slots.values():
+            size += sys.getsizeof(job_ids)
+        return size
+
+    def due(self, now_utc=None):
+        # IDs of the jobs due in the slot containing now_utc
+        if now_utc is None:
+            now_utc = datetime.now(UTC)
+        return frozenset(self._slots.get(self.advance(now_utc), ()))
+
+
+class JobRecord:
+    # One registered job. Its rule strings are interned and shared with every
+    # other job using the same rules, its exdates are sorted int64 epoch seconds
+    # and its calendars a shared tuple; no datetimes or rulesets are kept per job.
+
+    __slots__ = ("job_id", "rules", "exdates", "calendars", "registry")
+
+    def __init__(self, job_id, rules, exdates, calendars, registry):
+        self.job_id = job_id
+        self.rules = rules
+        self.exdates = exdates
+        self.calendars = calendars
+        self.registry = registry
+
+    def excluded(self, ts):
+        exdates = self.exdates
         if exdates:
-            for exdate in exdates:
-                # Ensure exdate is in UTC
-                if exdate.tzinfo is None:
-                    exdate = exdate.replace(tzinfo=UTC)
+            i = bisect_left(exdates, ts)
+            if i < len(exdates) and exdates[i] == ts:
+                return True
+        return any(ts in calendar for calendar in self.calendars)
+
+    def between(self, now_utc, start, end):
+        # The job's occurrences in [start, end) epoch seconds, from the shared
+        # rule's occurrence index
+        index = self.registry.compiled(self.rules).index
+        return [
+            ts for ts in index.between(now_utc, start, end) if not self.excluded(ts)
+        ]
+
+    def next_after(self, now_utc, until):
+        # First occurrence at or after now_utc and before until, in epoch seconds.
+        # The shared index may stop short of until once its budget runs out, which
+        # only answers the job if one of the occurrences it holds is not excluded.
+        index = self.registry.compiled(self.rules).index
+        index.ensure(now_utc, until)
+        occurrences = index.occurrences
+        first = bisect_left(occurrences, math.ceil(now_utc.timestamp()))
+        for ts in occurrences[first:]:
+            if ts >= until:
+                return None
+            if not self.excluded(ts):
+                return ts
+        if index.end < until:
+            raise BudgetExceeded(
+                f"occurrences only known up to {from_epoch(index.end)}"
+            )
+        return None
+
+
+class JobRegistry:
+    # Compact store of registered jobs for large fleets. Identical (include,
+    # exclude) rule pairs are interned and compiled once, without any exdates,
+    # and only while some job uses them; each job then filters the shared
+    # occurrences through its own exdates and calendars. The job's full ruleset
+    # is only built when asked for.
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else RuleCache()
+        self._jobs = {}
+        self._rules = {}
+        self._users = defaultdict(int)
+        self._compiled = {}
+        self._calendar_sets = {}
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, job_id):
+        return job_id in self._jobs
+
+    def __getitem__(self, job_id):
+        return self._jobs[job_id]
+
+    def compiled(self, rules):
+        # The CompiledRule shared by every job with these (include, exclude) rules;
+        # it is only kept here while a registered job uses them
+        compiled = self._compiled.get(rules)
+        if compiled is None:
+            compiled = self.cache.get(*rules)
+            if rules in self._users:
+                self._compiled[rules] = compiled
+        return compiled
+
+    def add(self, job_id, include_rule, exclude_rule=None, exdates=None, calendars=()):
+        # Register a job, or replace it; the rules are compiled first, so a job
+        # with invalid rules is rejected and any previous registration kept
+        record = self.build(job_id, include_rule, exclude_rule, exdates, calendars)
+        self.insert(record)
+        return record
+
+    def build(
+        self, job_id, include_rule, exclude_rule=None, exdates=None, calendars=()
+    ):
+        # A JobRecord for the job, with its rules compiled, that is not registered
+        # until passed to insert
+        key = (include_rule, exclude_rule or None)
+        rules = self._rules.get(key, key)
+        self.compiled(rules)
+        timestamps = sorted(
+            {int(ts) for ts in exdate_timestamps(exdates) if ts == int(ts)}
+        )
+        calendars = tuple(calendars)
+        calendars = self._calendar_sets.setdefault(calendars, calendars)
+
+        return JobRecord(
+            job_id,
+            rules,
+            array("q", timestamps) if timestamps else None,
+            calendars,
+            self,
+        )
+
+    def insert(self, record):
+        # Register a record from build, replacing any job with the same ID
+        self.remove(record.job_id)
+        self._rules.setdefault(record.rules, record.rules)
+        self._users[record.rules] += 1
+        self._jobs[record.job_id] = record
+
+    def remove(self, job_id):
+        record = self._jobs.pop(job_id, None)
+        if record is None:
+            return False
+        self._users[record.rules] -= 1
+        if not self._users[record.rules]:
+            del self._users[record.rules]
+            del self._rules[record.rules]
+            self._compiled.pop(record.rules, None)
+        return True
+
+    def check(
+        self, job_id, now_utc=None, slot_width=SLOT_WIDTH, slot_offset=SLOT_OFFSET
+    ):
+        # check_rrule_in_slot for a registered job
+        record = self._jobs[job_id]
+        try:
+            if now_utc is None:
+                now_utc = datetime.now(UTC)
+            _, slot_end_utc = slot_bounds(now_utc, slot_width, slot_offset)
+            if record.next_after(now_utc, int(slot_end_utc.timestamp())) is None:
+                return 1
+            return 0
+        except BudgetExceeded as e:
+            logger.error("Evaluation budget exceeded: %s", e)
+            return BUDGET_EXCEEDED
+        except Exception as e:
+            logger.error("Error: %s", e)
+            return -1
+
+    def ruleset(self, job_id):
+        # The job's complete rruleset, built on demand; calendars are not part of it
+        record = self._jobs[job_id]
+        exdates = [from_epoch(ts) for ts in record.exdates or ()]
+        return compile_rules(*record.rules, exdates)
+
+    def footprint(self, slots=None):
+        # Approximate bytes held for the registered jobs: their records, IDs and
+        # exdate arrays, the interned rule strings, the occurrence arrays of the
+        # shared compiled rules and, if given, the SlotIndex they are kept in
+        size = sys.getsizeof(self._jobs)
+        if slots is not None:
+            size += slots.footprint()
+        for job_id, record in self._jobs.items():
+            size += sys.getsizeof(record) + sys.getsizeof(job_id)
+            if record.exdates is not None:
+                size += sys.getsizeof(record.exdates)
+        for rules in self._rules:
+            size += sum(sys.getsizeof(rule) for rule in rules if rule is not None)
+        for compiled in self._compiled.values():
+            size += sys.getsizeof(compiled.index.occurrences)
+        jobs = len(self._jobs)
+        return {
+            "jobs": jobs,
+            "rules": len(self._rules),
+            "bytes": size,
+            "bytes_per_job": size / jobs if jobs else 0,
+        }
+
+
+class OccurrenceStore:
+    # On-disk cache of occurrence index windows for one-shot processes, one file
+    # per rule named by a hash of its normalized inputs. A file holds a fixed
+    # header (magic, window start, window end, count) followed by the sorted
+    # occurrences over [start, end), all native int64 epoch seconds, and is read
+    # through mmap so a hit needs neither the rule parsed nor the ruleset iterated.
+    # Files are replaced atomically, stale windows are rewritten, and the least
+    # recently used files are evicted once the directory exceeds max_bytes. The
+    # directory is only scanned for that on a random sample of writes, on average
+    # once every EVICT_EVERY of max_bytes written, so it may briefly overshoot.
+
+    HEADER = struct.Struct("=8sqqq")
+    OCCURRENCE = struct.Struct("=q")
+    MAGIC = b"SLOTOCC" + sys.byteorder[0].upper().encode()
+    SUFFIX = ".occ"
+    EVICT_EVERY = 1 / 16
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, rrule_str, exrule_str=None, exdates=None, calendars=()):
+        normalized = [
+            " ".join(rrule_str.split()),
+            " ".join(exrule_str.split()) if exrule_str else None,
+            [exdate.isoformat() for exdate in normalize_exdates(exdates)],
+            [(calendar.name, calendar.digest) for calendar in calendars],
+        ]
+        return hashlib.blake2b(
+            json.dumps(normalized).encode(), digest_size=16
+        ).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def lookup(self, key, now_ts, until):
+        # (True, first stored occurrence in [now_ts, until) or None) if the stored
+        # window covers that range, else (False, None)
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as m:
+                magic, start, end, n = self.HEADER.unpack_from(m)
+                if (
+                    magic != self.MAGIC
+                    or len(m) != self.HEADER.size + 8 * n
+                    or not start <= now_ts <= until <= end
+                ):
+                    return False, None
+                found = self._first_at_or_after(m, n, now_ts)
+                if found is not None and found >= until:
+                    found = None
+        except (OSError, ValueError, struct.error):
+            return False, None
+        # Mark the file recently used; a read-only cache still answers
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True, found
+
+    def _first_at_or_after(self, m, n, ts):
+        # Binary search of the n mapped occurrences, read in place
+        occurrence = self.OCCURRENCE
+        base = self.HEADER.size
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if occurrence.unpack_from(m, base + 8 * mid)[0] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return occurrence.unpack_from(m, base + 8 * lo)[0] if lo < n else None
+
+    def save(self, key, index):
+        # Write an occurrence index window; a failure only costs the next process
+        # a recomputation
+        import tempfile
+
+        header = self.HEADER.pack(
+            self.MAGIC, index.start, index.end, len(index.occurrences)
+        )
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(header)
+                    f.write(index.occurrences.tobytes())
+                os.replace(tmp, self.path(key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            size = len(header) + len(index.occurrences) * self.OCCURRENCE.size
+            sample = int.from_bytes(os.urandom(4), "little") / 2**32
+            if sample * self.max_bytes * self.EVICT_EVERY < size:
+                self.evict()
+        except OSError as e:
+            logger.error("Error: could not write occurrence cache: %s", e)
+
+    def evict(self):
+        # Remove least recently used files until the directory fits in max_bytes
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(self.SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# Shared by check_rrule_in_slot callers that do not bring their own cache. Only
+# the slot being checked is materialized, so a cold call costs no more than the
+# check itself; the daemon and --cache-dir set a horizon.
+rule_cache = RuleCache(horizon=timedelta(0))
+
+
+def check_rrule_in_slot(
+    rrule_str,
+    exrule_str=None,
+    exdates=None,
+    now_utc=None,
+    cache=None,
+    slot_width=SLOT_WIDTH,
+    slot_offset=SLOT_OFFSET,
+    calendars=(),
+    store=None,
+):
+    # An invalid slot is the caller's error rather than the rule's, so it raises
+    slot_seconds(slot_width, slot_offset)
+    count("checks")
+    with timed("check"):
+        try:
+            # Get the current UTC time unless the caller froze it, and log it
+            if now_utc is None:
+                now_utc = datetime.now(UTC)
+            logger.info("Current UTC time: %s", now_utc)
+
+            # Round down the current UTC time to the start of its slot
+            slot_start_utc, slot_end_utc = slot_bounds(now_utc, slot_width, slot_offset)
+            logger.info("Slot start: %s, Slot end: %s", slot_start_utc, slot_end_utc)
+            until = int(slot_end_utc.timestamp())
+
+            # Occurrences a previous process left in the on-disk store, if any
+            found = False
+            if store is not None:
+                key = store.key(rrule_str, exrule_str, exdates, calendars)
+                with timed("store"):
+                    found, next_occurrence = store.lookup(
+                        key, math.ceil(now_utc.timestamp()), until
+                    )
+                count("store_hits" if found else "store_misses")
+
+            if not found:
+                # Look up (or compile) the rules for this include/exclude/exdate/
+                # calendar combination
+                if cache is None:
+                    cache = rule_cache
+                compiled = cache.get(rrule_str, exrule_str, exdates, calendars)
+
+                # Find the next occurrence at or after the current UTC time that
+                # falls before the end of the slot, from the rule's precomputed
+                # occurrences
+                next_occurrence = compiled.index.next_after(now_utc, until=until)
+                if store is not None:
+                    store.save(key, compiled.index)
+
+            # Check if the next occurrence is within the current slot
+            if next_occurrence is not None:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "Next occurrence (UTC): %s", from_epoch(next_occurrence)
+                    )
+                logger.info("Job is within the slot and will be scheduled.")
+                return 0  # Next occurrence is within the slot
+            else:
+                logger.info("Job is not within the slot and will not be scheduled.")
+                return 1  # Next occurrence is not within the slot
+
+        except BudgetExceeded as e:
+            logger.error("Evaluation budget exceeded: %s", e)
+            return BUDGET_EXCEEDED
+
+        except Exception as e:
+            logger.error("Error: %s", e)
+            return -1  # Return -1 on error
+
+
+def parse_exdates(dt_strs):
+    # Parse exclude datetimes from strings to datetime objects
+    return [datetime.fromisoformat(dt_str) for dt_str in dt_strs or []]
+
+
+def load_jobs(path):
+    # Yield one job dict per manifest entry; CSV if the extension says so, else JSONL.
+    # CSV rows carry their exclude datetimes space separated in a single column.
+    import csv
+
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield {
+                    "job_id": row["job_id"],
+                    "include_rule": row["include_rule"],
+                    "exclude_rule": row.get("exclude_rule") or None,
+                    "exclude_datetimes": (row.get("exclude_datetimes") or "").split(),
+                    "calendars": (row.get("calendars") or "").split(),
+                }
+            return
+
+        for lineno, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict) or "job_id" not in job:
+                    raise ValueError("missing job_id")
+            except ValueError as e:
+                logger.error("Skipping malformed manifest line %s: %s", lineno, e)
+                continue
+            yield job
+
+
+def has_fixed_offset(tzinfo):
+    # Whether a zone's UTC offset never changes, so its wall-clock periods are
+    # exact in epoch seconds. dateutil parses "Z" as tzlocal() on hosts in UTC.
+    from dateutil.tz import tzfile, tzlocal, tzoffset, tzutc
+
+    if isinstance(tzinfo, (tzutc, tzoffset, timezone)):
+        return True
+    if isinstance(tzinfo, tzlocal):
+        return not tzinfo._hasdst
+    if isinstance(tzinfo, tzfile):
+        return not tzinfo._trans_list
+    return False
+
+
+class ZoneTable:
+    # UTC offsets of a DST zone as a step function of naive local epoch seconds,
+    # tabulated over a window around the times looked up: offsets[i] applies from
+    # bounds[i - 1] up to bounds[i]. Each step is located by asking the zone
+    # itself, so ambiguous times (fold=0, the earlier offset) and nonexistent
+    # times convert exactly as datetime.timestamp() does through dateutil.
+    # bounds is None for a window where the zone does not step once per
+    # transition; lookups there fall back to dateutil.
+
+    __slots__ = ("tzinfo", "start", "end", "bounds", "offsets")
+
+    def __init__(self, tzinfo):
+        self.tzinfo = tzinfo
+        self.start = self.end = 0
+        self.bounds = self.offsets = None
+
+    def offset(self, local):
+        wall = (NAIVE_EPOCH + timedelta(seconds=local)).replace(tzinfo=self.tzinfo)
+        return int(wall.utcoffset().total_seconds())
+
+    def utc_offset(self, ts):
+        return int(from_epoch(ts).astimezone(self.tzinfo).utcoffset().total_seconds())
+
+    def build(self, local):
+        # Tabulate [local - ZONE_TABLE_SPAN, local + ZONE_TABLE_SPAN)
+        self.start = start = local - ZONE_TABLE_SPAN
+        self.end = end = local + ZONE_TABLE_SPAN
+        self.bounds = self.offsets = None
+        bounds = array("q")
+        offsets = array("q")
+        transitions = self.tzinfo._trans_list_utc
+        first = bisect_left(transitions, start - 86400)
+        for transition in transitions[first:]:
+            before = self.utc_offset(transition - 1)
+            after = self.utc_offset(transition)
+            low = transition + min(before, after)
+            high = transition + max(before, after)
+            if high + ZONE_CHECK_MARGIN <= start:
+                continue
+            if low - ZONE_CHECK_MARGIN >= end:
+                break
+            if before == after:
+                # astimezone() can misplace a transition (Casablanca's negative
+                # DST in 2037), so make sure the wall clock agrees nothing changes
+                if self.offset(low - ZONE_CHECK_MARGIN) != self.offset(
+                    low + ZONE_CHECK_MARGIN
+                ):
+                    return
+                continue
+            if high <= start:
+                continue
+            if low >= end:
+                break
+            if offsets and offsets[-1] != before:
+                return
+            if self.offset(low - 1) != before or self.offset(high) != after:
+                return
+            while low < high:
+                middle = (low + high) // 2
+                if self.offset(middle) == after:
+                    high = middle
                 else:
-                    exdate = exdate.astimezone(UTC)
-                rules.exdate(exdate)
-                logger.info(f"Exclusion date added: {exdate}")
-
-        # Round down the current UTC time to the nearest 30 minutes
-        slot_start_utc = now_utc.replace(
-            minute=(now_utc.minute // 30) * 30, second=0, microsecond=0
-        )
-        slot_end_utc = slot_start_utc + timedelta(minutes=30)
-        logger.info(f"Slot start: {slot_start_utc}, Slot end: {slot_end_utc}")
-
-        # Find the next occurrence after the current UTC time
-        next_occurrence = rules.after(now_utc, inc=True)
-
-        # Convert next_occurrence to UTC if it has a timezone and log it
-        if next_occurrence:
-            logger.info(f"Next occurrence (original): {next_occurrence}")
-            if next_occurrence.tzinfo is not None:
-                next_occurrence = next_occurrence.astimezone(UTC)
-            logger.info(f"Next occurrence (UTC): {next_occurrence}")
-
-        # Check if the next occurrence is within the current slot
-        if next_occurrence and slot_start_utc <= next_occurrence < slot_end_utc:
-            logger.info("Job is within the slot and will be scheduled.")
-            return 0  # Next occurrence is within the slot
-        else:
-            logger.info("Job is not within the slot and will not be scheduled.")
-            return 1  # Next occurrence is not within the slot
+                    low = middle + 1
+            if not offsets:
+                offsets.append(before)
+            bounds.append(low)
+            offsets.append(after)
+        if not offsets:
+            offsets.append(self.offset(start))
+        if offsets[0] != self.offset(start):
+            return
+        self.bounds = bounds
+        self.offsets = offsets
+        count("zone_tables_built")
+
+    def to_utc(self, local):
+        # Epoch seconds for naive local epoch seconds, or None to use dateutil
+        if not self.start <= local < self.end:
+            self.build(local)
+        if self.bounds is None:
+            return None
+        return local - self.offsets[bisect_right(self.bounds, local)]
+
+
+def zone_table(tzinfo):
+    # The shared transition table of a zone with DST transitions, or None for
+    # zones whose offsets dateutil resolves cheaply or without a transition list
+    from dateutil.tz import tzfile
+
+    table = zone_tables.get(id(tzinfo))
+    if table is None and isinstance(tzinfo, tzfile) and tzinfo._trans_list_utc:
+        # The table keeps its zone alive, so the id() stays unique
+        table = zone_tables[id(tzinfo)] = ZoneTable(tzinfo)
+    return table
+
+
+def utc_timestamp(dt):
+    # Epoch seconds of an aware datetime, through its zone's transition table
+    # when it has one
+    table = zone_table(dt.tzinfo)
+    if table is not None and not dt.fold and not dt.microsecond:
+        delta = dt.replace(tzinfo=None) - NAIVE_EPOCH
+        ts = table.to_utc(delta.days * 86400 + delta.seconds)
+        if ts is not None:
+            return ts
+    return dt.timestamp()
+
+
+@lru_cache(maxsize=4096)
+def simple_rule(rrule_str):
+    # (dtstart, interval, count, until) of a rule the batch fast path can evaluate
+    # with modular arithmetic, or None. Simple rules are a single MINUTELY, HOURLY
+    # or DAILY RRULE without BY* parts, RDATEs or EXDATEs, starting in UTC or a
+    # fixed-offset zone. dtstart and until are epoch seconds, interval is in
+    # seconds and a missing COUNT or UNTIL is UNBOUNDED.
+    from dateutil.rrule import rrulestr
+
+    if not isinstance(rrule_str, str):
+        return None
+    try:
+        rules = rrulestr(rrule_str, forceset=True)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if len(rules._rrule) != 1 or rules._exrule or rules._rdate or rules._exdate:
+        return None
+    (rule,) = rules._rrule
+    period = SIMPLE_FREQS.get(rule._freq)
+    if (
+        period is None
+        or rule._interval < 1
+        or not has_fixed_offset(rule._dtstart.tzinfo)
+        or any(value is not None for value in rule._original_rule.values())
+        or empty_rule_reason(rule)
+    ):
+        return None
+    return (
+        int(rule._dtstart.timestamp()),
+        period * rule._interval,
+        UNBOUNDED if rule._count is None else rule._count,
+        UNBOUNDED if rule._until is None else math.floor(rule._until.timestamp()),
+    )
+
+
+class SimpleRuleBatch:
+    # Simple rules (see simple_rule) of a batch of jobs as int64 columns, so the
+    # whole batch is checked against a slot with a few NumPy array operations
+
+    def __init__(self):
+        self.positions = []
+        self.starts = array("q")
+        self.intervals = array("q")
+        self.counts = array("q")
+        self.untils = array("q")
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, position, params):
+        start, interval, count, until = params
+        self.positions.append(position)
+        self.starts.append(start)
+        self.intervals.append(interval)
+        self.counts.append(count)
+        self.untils.append(until)
+
+    def statuses(self, now_ts, slot_end):
+        # 0 where the first occurrence at or after now_ts (epoch seconds, rounded
+        # up as the occurrence index does) is before slot_end, else 1
+        np = load_numpy()
+        if np is None:
+            statuses = []
+            for start, interval, count, until in zip(
+                self.starts, self.intervals, self.counts, self.untils
+            ):
+                k = max(0, -((start - now_ts) // interval))
+                ts = start + k * interval
+                statuses.append(0 if ts < slot_end and k < count and ts <= until else 1)
+            return statuses
+
+        starts = np.frombuffer(self.starts, dtype=np.int64)
+        intervals = np.frombuffer(self.intervals, dtype=np.int64)
+        k = np.maximum(0, -((starts - now_ts) // intervals))
+        ts = starts + k * intervals
+        hit = ts < slot_end
+        hit &= k < np.frombuffer(self.counts, dtype=np.int64)
+        hit &= ts <= np.frombuffer(self.untils, dtype=np.int64)
+        return np.where(hit, 0, 1).tolist()
+
+
+def parse_shard(spec):
+    # "i/n" as (i, n), shards being numbered from 0 to n - 1
+    index, sep, total = spec.partition("/")
+    try:
+        index, total = int(index), int(total)
+    except ValueError:
+        raise ValueError(f"expected a shard as i/n, got {spec!r}") from None
+    if not sep or not 0 <= index < total:
+        raise ValueError(f"shard {spec!r} is not one of 0/n to n-1/n")
+    return index, total
+
+
+def shard_of(job_id, shards):
+    # Rendezvous hashing: a job belongs to the shard with the highest hash of
+    # (shard, job ID). Adding jobs never moves others, and changing the number of
+    # shards only moves jobs to or from the shards added or removed.
+    key = str(job_id).encode()
+    return max(
+        range(shards),
+        key=lambda shard: hashlib.blake2b(
+            b"%d:%s" % (shard, key), digest_size=8
+        ).digest(),
+    )
+
+
+def select_shard(jobs, shard):
+    # The jobs in shard (i, n), in their original order
+    index, total = shard
+    for job in jobs:
+        if shard_of(job["job_id"], total) == index:
+            yield job
+
+
+def _batches(items, size):
+    # Consecutive lists of up to size items
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _evaluate_batch(jobs, now_utc, cache, slot_width, slot_offset, fast_path):
+    # Statuses of a list of jobs, in order: simple rules go through a
+    # SimpleRuleBatch and everything else through check_rrule_in_slot
+    statuses = [None] * len(jobs)
+    simple = SimpleRuleBatch()
+    for position, job in enumerate(jobs):
+        count("jobs_evaluated")
+        try:
+            exdates = parse_exdates(job.get("exclude_datetimes"))
+            job_calendars = resolve_calendars(job.get("calendars"))
+        except (ValueError, TypeError) as e:
+            logger.error("Error: invalid exclusions for %s: %s", job["job_id"], e)
+            statuses[position] = -1
+            continue
+        include_rule = job.get("include_rule")
+        # simple_rule is cached, so a rule that is not a string (and possibly not
+        # hashable) is left for check_rrule_in_slot to report
+        if (
+            fast_path
+            and isinstance(include_rule, str)
+            and not (exdates or job_calendars or job.get("exclude_rule"))
+        ):
+            params = simple_rule(include_rule)
+            if params is not None:
+                simple.add(position, params)
+                continue
+        statuses[position] = check_rrule_in_slot(
+            include_rule,
+            job.get("exclude_rule"),
+            exdates,
+            now_utc=now_utc,
+            cache=cache,
+            slot_width=slot_width,
+            slot_offset=slot_offset,
+            calendars=job_calendars,
+        )
+
+    if simple:
+        _, slot_end_utc = slot_bounds(now_utc, slot_width, slot_offset)
+        with timed("simple"):
+            results = simple.statuses(
+                math.ceil(now_utc.timestamp()), int(slot_end_utc.timestamp())
+            )
+        for position, status in zip(simple.positions, results):
+            statuses[position] = status
+        count("simple_jobs", len(simple))
+    return statuses
+
+
+def evaluate_jobs(
+    jobs,
+    now_utc=None,
+    cache=None,
+    slot_width=SLOT_WIDTH,
+    slot_offset=SLOT_OFFSET,
+    fast_path=True,
+    batch_size=BATCH_SIZE,
+    shard=None,
+):
+    # Evaluate every job against one frozen "now" so a whole tick sees the same slot.
+    # Jobs are read batch_size at a time so simple rules can be vectorized; results
+    # are the same with fast_path off, which sends every job through
+    # check_rrule_in_slot. With shard (i, n), only that shard's jobs are evaluated.
+    if now_utc is None:
+        now_utc = datetime.now(UTC)
+    if shard is not None:
+        jobs = select_shard(jobs, shard)
+    slot_start = slot_bounds(now_utc, slot_width, slot_offset)[0].isoformat()
+
+    for batch in _batches(jobs, batch_size):
+        statuses = _evaluate_batch(
+            batch, now_utc, cache, slot_width, slot_offset, fast_path
+        )
+        yield from _decisions(batch, statuses, slot_start)
+
+
+def _decisions(jobs, statuses, slot_start):
+    for job, status in zip(jobs, statuses):
+        yield {"job_id": job["job_id"], "status": status, "slot_start": slot_start}
+
+
+def _init_worker(cache_settings, shared_calendars, log_level, metric_buckets):
+    # Runs once in each pool process: compiled rules are then kept in the
+    # process's own rule_cache, with the parent's limits and calendars, and
+    # metrics are recorded if the parent records them
+    (
+        rule_cache.maxsize,
+        rule_cache.horizon,
+        rule_cache.max_iterations,
+        rule_cache.max_seconds,
+    ) = cache_settings
+    calendars.clear()
+    calendars.update(shared_calendars)
+    logging.getLogger().setLevel(log_level)
+    if metric_buckets is not None:
+        enable_metrics(metric_buckets)
+
+
+def _evaluate_chunk(jobs, now_utc, slot_width, slot_offset):
+    # The chunk's statuses, and the metrics recorded evaluating it (or None) for
+    # the parent to merge into its own
+    if metrics is not None:
+        enable_metrics(metrics.buckets)
+    statuses = _evaluate_batch(jobs, now_utc, rule_cache, slot_width, slot_offset, True)
+    return statuses, metrics
+
+
+def evaluate_jobs_parallel(
+    jobs,
+    workers,
+    now_utc=None,
+    cache=None,
+    slot_width=SLOT_WIDTH,
+    slot_offset=SLOT_OFFSET,
+    chunk_size=BATCH_SIZE,
+    shard=None,
+):
+    # evaluate_jobs spread over a pool of worker processes. Every chunk is
+    # evaluated against the same frozen "now", and decisions come back in manifest
+    # order; at most two chunks per worker are in flight, so the manifest is still
+    # streamed. cache only supplies the limits for the workers' own caches, and
+    # metrics the workers record are merged into this process's.
+    from concurrent.futures import ProcessPoolExecutor
+
+    if now_utc is None:
+        now_utc = datetime.now(UTC)
+    if shard is not None:
+        jobs = select_shard(jobs, shard)
+    slot_start = slot_bounds(now_utc, slot_width, slot_offset)[0].isoformat()
+    cache = cache if cache is not None else rule_cache
+    settings = (cache.maxsize, cache.horizon, cache.max_iterations, cache.max_seconds)
+
+    buckets = metrics.buckets if metrics is not None else None
+
+    def results(future):
+        statuses, chunk_metrics = future.result()
+        if chunk_metrics is not None and metrics is not None:
+            metrics.merge(chunk_metrics)
+        return statuses
+
+    with ProcessPoolExecutor(
+        workers,
+        initializer=_init_worker,
+        initargs=(settings, dict(calendars), logging.getLogger().level, buckets),
+    ) as pool:
+        pending = deque()
+        for chunk in _batches(jobs, chunk_size):
+            future = pool.submit(
+                _evaluate_chunk, chunk, now_utc, slot_width, slot_offset
+            )
+            pending.append((chunk, future))
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield from _decisions(chunk, results(future), slot_start)
+        for chunk, future in pending:
+            yield from _decisions(chunk, results(future), slot_start)
+
+
+def run_jobs_file(
+    path,
+    out=None,
+    cache=None,
+    slot_width=SLOT_WIDTH,
+    slot_offset=SLOT_OFFSET,
+    workers=1,
+    shard=None,
+):
+    # Stream one JSONL decision per manifest job to stdout, using a pool of
+    # worker processes if more than one worker is asked for. With shard (i, n),
+    # only that shard's jobs are evaluated and a final {"shard", "slot_start",
+    # "jobs"} summary line lets merge_shards check the outputs are complete.
+    out = out or sys.stdout
+    cache = cache if cache is not None else rule_cache
+    now_utc = datetime.now(UTC)
+    slot = {"slot_width": slot_width, "slot_offset": slot_offset, "shard": shard}
+    if workers > 1:
+        decisions = evaluate_jobs_parallel(
+            load_jobs(path), workers, now_utc, cache, **slot
+        )
+    else:
+        decisions = evaluate_jobs(load_jobs(path), now_utc, cache, **slot)
+    jobs = 0
+    for decision in decisions:
+        out.write(json.dumps(decision) + "\n")
+        jobs += 1
+    if shard is not None:
+        summary = {
+            "shard": "%d/%d" % shard,
+            "slot_start": slot_bounds(now_utc, slot_width, slot_offset)[0].isoformat(),
+            "jobs": jobs,
+        }
+        out.write(json.dumps(summary) + "\n")
+    out.flush()
+    # Workers compile into caches of their own, which this one does not see
+    if workers == 1:
+        logger.info("Rule cache: %s", cache.stats())
+
 
+def _job_slots(
+    order, job, start_ts, end_ts, cache, slot_width, slot_offset, on_error=None
+):
+    # One sweep over a job's occurrences in [start_ts, end_ts), yielding each slot
+    # it fires in once as (slot number, manifest order, job_id). If the sweep
+    # stops early, on_error is called with the job ID and the exception.
+    try:
+        compiled = cache.get(
+            job.get("include_rule"),
+            job.get("exclude_rule"),
+            parse_exdates(job.get("exclude_datetimes")),
+            resolve_calendars(job.get("calendars")),
+        )
+        start = from_epoch(start_ts)
+        last = None
+        for ts in compiled.occurrences(start, start, end=end_ts):
+            if ts >= end_ts:
+                break
+            slot = slot_number(ts, slot_width, slot_offset)
+            if slot != last:
+                last = slot
+                yield slot, order, job["job_id"]
     except Exception as e:
-        logger.error(f"Error: {e}")
-        return -1  # Return -1 on error
+        logger.error("Error: forecast for %s stopped: %s", job["job_id"], e)
+        if on_error is not None:
+            on_error(job["job_id"], e)
+
+
+def forecast(
+    jobs,
+    start,
+    end,
+    cache=None,
+    slot_width=SLOT_WIDTH,
+    slot_offset=SLOT_OFFSET,
+    on_error=None,
+):
+    # Lazily yield (slot_start, job_id) for every slot starting in [start, end), past
+    # or future, in which a job has an occurrence; a job fires in a slot exactly
+    # when check_rrule_in_slot would schedule it at the slot start. Output is in
+    # slot order, ties in job order, from a single sweep per rule. A job whose
+    # sweep fails stops there, and on_error(job_id, exception) is called when the
+    # output reaches that point.
+    cache = cache if cache is not None else rule_cache
+    width, offset = slot_seconds(slot_width, slot_offset)
+    # Slots are those after the one containing the second before start, up to the
+    # one containing the second before end
+    first = slot_number(math.ceil(start.timestamp()) - 1, slot_width, slot_offset) + 1
+    last = slot_number(math.ceil(end.timestamp()) - 1, slot_width, slot_offset)
+    start_ts = first * width + offset
+    end_ts = (last + 1) * width + offset
+
+    streams = [
+        _job_slots(
+            order, job, start_ts, end_ts, cache, slot_width, slot_offset, on_error
+        )
+        for order, job in enumerate(jobs)
+    ]
+    for slot, _, job_id in heapq.merge(*streams):
+        yield from_epoch(slot * width + offset), job_id
+
+
+def run_forecast(
+    path,
+    start,
+    end,
+    out=None,
+    slot_width=SLOT_WIDTH,
+    slot_offset=SLOT_OFFSET,
+    shard=None,
+):
+    # Stream one JSONL line per (slot_start, job_id) decision to stdout. A job
+    # whose forecast stops early gets a {"job_id", "error"} line where it
+    # stopped, so the stream is never silently incomplete; returns the number of
+    # such jobs.
+    out = out or sys.stdout
+    jobs = load_jobs(path)
+    if shard is not None:
+        jobs = select_shard(jobs, shard)
+    failed = []
+
+    def on_error(job_id, e):
+        failed.append(job_id)
+        out.write(json.dumps({"job_id": job_id, "error": str(e)}) + "\n")
+
+    decisions = forecast(
+        jobs,
+        start,
+        end,
+        slot_width=slot_width,
+        slot_offset=slot_offset,
+        on_error=on_error,
+    )
+    for slot_start, job_id in decisions:
+        out.write(
+            json.dumps({"slot_start": slot_start.isoformat(), "job_id": job_id}) + "\n"
+        )
+    out.flush()
+    return len(failed)
+
+
+class ShardMergeError(ValueError):
+    pass
+
+
+def _read_shard_output(path):
+    # (summary, decisions) of one sharded run_jobs_file output
+    summary = None
+    decisions = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ShardMergeError(f"{path}:{lineno}: {e}") from None
+            if "shard" in record:
+                summary = record
+            elif "job_id" in record and "slot_start" in record:
+                decisions.append(record)
+            else:
+                raise ShardMergeError(f"{path}:{lineno}: not a scheduling decision")
+    if summary is None:
+        raise ShardMergeError(f"{path}: no shard summary, output is incomplete")
+    if summary["jobs"] != len(decisions):
+        raise ShardMergeError(
+            f"{path}: shard {summary['shard']} has {len(decisions)} of "
+            f"{summary['jobs']} decisions"
+        )
+    return summary, decisions
+
+
+def merge_shards(paths, out=None):
+    # Combine the outputs of every shard of one split for one slot into a single
+    # JSONL stream, in shard order. Raises ShardMergeError on missing or duplicate
+    # shards, outputs from different splits or slots, and jobs seen twice.
+    out = out or sys.stdout
+    shards = {}
+    totals = set()
+    slot_starts = set()
+    for path in paths:
+        summary, decisions = _read_shard_output(path)
+        try:
+            index, total = parse_shard(summary["shard"])
+        except ValueError as e:
+            raise ShardMergeError(f"{path}: {e}") from None
+        if totals and total not in totals:
+            raise ShardMergeError(
+                f"outputs of different splits: {path} is shard {summary['shard']}, "
+                f"the others are of {next(iter(totals))} shards"
+            )
+        if index in shards:
+            raise ShardMergeError(
+                f"duplicate shard {summary['shard']} in {shards[index][0]} and {path}"
+            )
+        shards[index] = (path, decisions)
+        totals.add(total)
+        slot_starts.add(summary["slot_start"])
+        slot_starts.update(decision["slot_start"] for decision in decisions)
+
+    if len(slot_starts) > 1:
+        raise ShardMergeError(f"outputs for different slots: {sorted(slot_starts)}")
+    (total,) = totals or {0}
+    missing = sorted(set(range(total)) - shards.keys())
+    if missing:
+        raise ShardMergeError(
+            "missing shard(s) " + ", ".join(f"{index}/{total}" for index in missing)
+        )
+
+    seen = {}
+    for index in sorted(shards):
+        path, decisions = shards[index]
+        for decision in decisions:
+            job_id = decision["job_id"]
+            if job_id in seen:
+                raise ShardMergeError(
+                    f"job {job_id} decided in both {seen[job_id]} and {path}"
+                )
+            seen[job_id] = path
+    for index in sorted(shards):
+        for decision in shards[index][1]:
+            out.write(json.dumps(decision) + "\n")
+    out.flush()
+    return len(seen)
+
+
+class SchedulerService:
+    # In-memory job registry answering register/unregister/check/due requests.
+    # Jobs are held in a JobRegistry sharing compiled rules through the service's
+    # RuleCache, and every registered job is kept in a SlotIndex over the next
+    # window of slots, so checks and due lists avoid recompiling anything.
+    # If metrics are enabled they are exported to the given files every slot.
+    # When serving, requests and ticks run one at a time on a worker thread, so
+    # compiling or indexing a slow rule does not stall the event loop.
+
+    def __init__(
+        self,
+        cache=None,
+        window=SLOT_WINDOW,
+        slot_width=SLOT_WIDTH,
+        slot_offset=SLOT_OFFSET,
+        metrics_json=None,
+        metrics_prom=None,
+    ):
+        self.cache = cache if cache is not None else RuleCache()
+        self.metrics_json = metrics_json
+        self.metrics_prom = metrics_prom
+        self.jobs = JobRegistry(self.cache)
+        self.slots = SlotIndex(window, slot_width, slot_offset)
+        self._worker = None
+
+    def register(
+        self,
+        job_id,
+        include_rule,
+        exclude_rule=None,
+        exclude_datetimes=None,
+        calendar_names=None,
+    ):
+        # The job is indexed before it replaces anything, so a job that cannot be
+        # registered keeps any previous registration. A job that cannot be indexed
+        # within its budget is rejected rather than walked again every window.
+        exdates = parse_exdates(exclude_datetimes)
+        job_calendars = resolve_calendars(calendar_names)
+        record = self.jobs.build(
+            job_id, include_rule, exclude_rule, exdates, job_calendars
+        )
+        if self.slots.start is None:
+            self.slots.advance(datetime.now(UTC))
+        self.slots.add(job_id, record)
+        self.jobs.insert(record)
+        logger.info("Registered job %s", job_id)
+
+    def unregister(self, job_id):
+        self.slots.remove(job_id)
+        return self.jobs.remove(job_id)
+
+    def check(self, job_id, now_utc=None):
+        return self.jobs.check(
+            job_id, now_utc, self.slots.slot_width, self.slots.slot_offset
+        )
+
+    def due(self, now_utc=None):
+        return sorted(self.slots.due(now_utc))
+
+    def slot_bounds(self, now_utc):
+        return slot_bounds(now_utc, self.slots.slot_width, self.slots.slot_offset)
+
+    def handle(self, request):
+        # Answer one decoded request; failures are reported, never raised
+        try:
+            op = request.get("op")
+            now_utc = datetime.now(UTC)
+            slot_start = self.slot_bounds(now_utc)[0].isoformat()
+            if op == "register":
+                self.register(
+                    request["job_id"],
+                    request["include_rule"],
+                    request.get("exclude_rule"),
+                    request.get("exclude_datetimes"),
+                    request.get("calendars"),
+                )
+                return {"ok": True}
+            if op == "unregister":
+                return {"ok": True, "removed": self.unregister(request["job_id"])}
+            if op == "check":
+                if request["job_id"] not in self.jobs:
+                    return {"ok": False, "error": f"unknown job {request['job_id']}"}
+                status = self.check(request["job_id"], now_utc)
+                return {"ok": True, "status": status, "slot_start": slot_start}
+            if op == "due":
+                return {
+                    "ok": True,
+                    "job_ids": self.due(now_utc),
+                    "slot_start": slot_start,
+                }
+            if op == "stats":
+                return {
+                    "ok": True,
+                    "jobs": len(self.jobs),
+                    "cache": self.cache.stats(),
+                    "memory": self.jobs.footprint(self.slots),
+                }
+            if op == "metrics":
+                if metrics is None:
+                    return {"ok": False, "error": "metrics are disabled"}
+                return {"ok": True, "metrics": metrics.to_dict()}
+            return {"ok": False, "error": f"unknown op {op!r}"}
+        except Exception as e:
+            logger.error("Error: %s", e)
+            return {"ok": False, "error": str(e)}
+
+    async def _run(self, func, *args):
+        # Run func on the worker thread
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._worker, func, *args
+        )
+
+    async def _client(self, reader, writer):
+        # One JSON request per line, one JSON response per line
+        import asyncio
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    # The rest of an overlong line cannot be told from the next
+                    # request, so the connection is closed after replying
+                    response = {"ok": False, "error": f"invalid request: {e}"}
+                    writer.write(json.dumps(response).encode() + b"\n")
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("request must be a JSON object")
+                except ValueError as e:
+                    response = {"ok": False, "error": f"invalid request: {e}"}
+                else:
+                    response = await self._run(self.handle, request)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _tick(self, slot_end):
+        due = self.slots.due(slot_end)
+        logger.info("Slot %s: %s job(s) due", slot_end, len(due))
+        try:
+            export_metrics(self.metrics_json, self.metrics_prom)
+        except OSError as e:
+            logger.error("Error: could not export metrics: %s", e)
+
+    async def tick(self):
+        # Roll the slot index forward at every slot boundary, so "due" lookups
+        # during the slot never have to extend it
+        import asyncio
+
+        while True:
+            now_utc = datetime.now(UTC)
+            slot_end = self.slot_bounds(now_utc)[1]
+            await asyncio.sleep((slot_end - now_utc).total_seconds())
+            await self._run(self._tick, slot_end)
+
+    async def serve(self, path):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Replace a stale socket left behind by a previous daemon, but never one a
+        # daemon is still listening on
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            if socket_in_use(path):
+                raise OSError(
+                    errno.EADDRINUSE, "a daemon is already listening on", path
+                )
+            os.unlink(path)
+        self._worker = ThreadPoolExecutor(max_workers=1)
+        try:
+            # Build the slot index before taking requests; jobs registered later
+            # are indexed one at a time
+            await self._run(self.slots.advance, datetime.now(UTC))
+            server = await asyncio.start_unix_server(
+                self._client, path=path, limit=MAX_REQUEST_BYTES
+            )
+            logger.info("Listening on %s", path)
+            async with server:
+                await asyncio.gather(server.serve_forever(), self.tick())
+        finally:
+            self._worker.shutdown(wait=False, cancel_futures=True)
+
+
+def socket_in_use(path):
+    # Whether something accepts connections on the Unix socket at path
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            return False
+    return True
+
+
+def query(path, request):
+    # Send one request to a daemon listening on the Unix socket at path
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
 
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser(
-        description="Check if the next occurrence of an rrule is within the current 30-minute slot."
+        description="Check if the next occurrence of an rrule is within the current "
+        "scheduling slot (30 minutes wide by default)."
     )
-    parser.add_argument(
-        "--include-rule", required=True, help="The inclusion rrule string."
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--include-rule", help="The inclusion rrule string.")
+    mode.add_argument(
+        "--jobs-file",
+        help="A JSONL or CSV manifest of jobs to evaluate in one pass; "
+        "one JSONL decision per job is written to stdout.",
+    )
+    mode.add_argument(
+        "--merge-shards",
+        nargs="+",
+        metavar="FILE",
+        help="Combine the --shard outputs of every node for one slot into one "
+        "JSONL stream, failing if a shard is missing or duplicated.",
+    )
+    mode.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        help="Run as a daemon answering JSON requests on this Unix socket.",
     )
     parser.add_argument(
         "--exclude-rule", required=False, help="The exclusion rrule string."
@@ -84,18 +2442,240 @@ def main():
         nargs="+",
         help="A list of datetimes to exclude (in ISO format).",
     )
+    parser.add_argument(
+        "--calendar",
+        action="append",
+        default=[],
+        metavar="NAME=PATH",
+        help="Load a named exclusion calendar (a list of ISO datetimes, or dates "
+        "excluding whole days, or an iCalendar file whose events and EXDATEs are "
+        "excluded) that jobs can reference; may be repeated.",
+    )
+    parser.add_argument(
+        "--exclude-calendars",
+        nargs="+",
+        metavar="NAME",
+        help="Exclusion calendars applied to --include-rule.",
+    )
+    parser.add_argument(
+        "--forecast",
+        nargs=2,
+        metavar=("FROM", "TO"),
+        help="With --jobs-file, stream the (slot_start, job_id) decisions for every "
+        "slot starting in [FROM, TO) (ISO datetimes, UTC if naive) instead of "
+        "checking the current slot. A job whose forecast stops early gets an "
+        '{"job_id", "error"} line and the exit status is -1.',
+    )
+    parser.add_argument(
+        "--slot-minutes",
+        type=float,
+        default=SLOT_WIDTH.total_seconds() / 60,
+        help="Width of a scheduling slot in minutes.",
+    )
+    parser.add_argument(
+        "--slot-offset-minutes",
+        type=float,
+        default=SLOT_OFFSET.total_seconds() / 60,
+        help="Offset of the slot grid from the Unix epoch (1970-01-01T00:00Z), in "
+        "minutes; slot n starts at n * width + offset after the epoch.",
+    )
+    parser.add_argument(
+        "--rule-cache-size",
+        type=int,
+        default=rule_cache.maxsize,
+        help="Maximum number of compiled rulesets kept in memory (0 disables the cache).",
+    )
+    parser.add_argument(
+        "--max-iterations",
+        type=int,
+        default=MAX_ITERATIONS,
+        help="Occurrences a rule may generate while looking for its next one "
+        f"before the check gives up with status {BUDGET_EXCEEDED}.",
+    )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=MAX_SECONDS,
+        help="Seconds a rule may spend looking for its next occurrence before "
+        f"the check gives up with status {BUDGET_EXCEEDED}.",
+    )
+    parser.add_argument(
+        "--index-horizon-hours",
+        type=float,
+        default=INDEX_HORIZON.total_seconds() / 3600,
+        help="How far ahead occurrences are precomputed per rule in daemon mode and for --cache-dir.",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="I/N",
+        help="With --jobs-file, only evaluate shard I of N (numbered from 0), "
+        "assigned by consistent hashing of job IDs.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="With --jobs-file, evaluate the manifest in N worker processes.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help="With --include-rule, keep the rule's precomputed occurrences in this "
+        "directory so later invocations can answer without evaluating the rule.",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=64,
+        help="Size of --cache-dir above which the least recently used rules are "
+        "evicted.",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        metavar="PATH",
+        help="Record per-phase timings and counters and write them to this JSON "
+        "file on exit (every slot in daemon mode).",
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        metavar="PATH",
+        help="Like --metrics-json, in the Prometheus text format for the "
+        "node_exporter textfile collector.",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="Only log messages at or above this level.",
+    )
 
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.cache_dir and not args.include_rule:
+        parser.error("--cache-dir requires --include-rule")
+    if args.shard:
+        if not args.jobs_file:
+            parser.error("--shard requires --jobs-file")
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(f"--shard: {e}")
+    # Logging is only configured for the command line, not when imported
+    logging.basicConfig(
+        level=args.log_level, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    if args.metrics_json or args.metrics_prom:
+        enable_metrics()
+    if args.forecast:
+        if not args.jobs_file:
+            parser.error("--forecast requires --jobs-file")
+        try:
+            args.forecast = [
+                dt if dt.tzinfo else dt.replace(tzinfo=UTC)
+                for dt in parse_exdates(args.forecast)
+            ]
+        except ValueError as e:
+            parser.error(f"--forecast: {e}")
+    try:
+        slot = {
+            "slot_width": timedelta(minutes=args.slot_minutes),
+            "slot_offset": timedelta(minutes=args.slot_offset_minutes),
+        }
+        slot_seconds(**slot)
+    except (ValueError, OverflowError) as e:
+        parser.error(f"invalid slot: {e}")
+    for spec in args.calendar:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            parser.error(f"--calendar expects NAME=PATH, got {spec!r}")
+        try:
+            load_calendar(name, path)
+        except (OSError, ValueError) as e:
+            parser.error(f"--calendar {name}: {e}")
+    rule_cache.maxsize = args.rule_cache_size
+    rule_cache.max_iterations = args.max_iterations
+    rule_cache.max_seconds = args.max_seconds
+    # A one-shot check or manifest run only needs the current slot materialized,
+    # unless the occurrences are kept for later invocations
+    if args.serve or args.cache_dir:
+        rule_cache.horizon = timedelta(hours=args.index_horizon_hours)
 
-    # Parse exclude datetimes from strings to datetime objects
-    exdates = []
-    if args.exclude_datetimes:
-        for dt_str in args.exclude_datetimes:
-            exdates.append(datetime.fromisoformat(dt_str))
+    try:
+        exit(run(args, parser, slot))
+    finally:
+        try:
+            export_metrics(args.metrics_json, args.metrics_prom)
+        except OSError as e:
+            logger.error("Error: could not export metrics: %s", e)
+
+
+def run(args, parser, slot):
+    # Run the mode selected on the command line and return its exit status
+    if args.jobs_file:
+        try:
+            if args.forecast:
+                start, end = args.forecast
+                if run_forecast(args.jobs_file, start, end, shard=args.shard, **slot):
+                    return -1
+            else:
+                run_jobs_file(
+                    args.jobs_file, workers=args.workers, shard=args.shard, **slot
+                )
+        except OSError as e:
+            logger.error("Error: %s", e)
+            return -1
+        return 0
+
+    if args.merge_shards:
+        try:
+            merge_shards(args.merge_shards)
+        except (OSError, ShardMergeError) as e:
+            logger.error("Error: %s", e)
+            return -1
+        return 0
+
+    if args.serve:
+        import asyncio
+
+        service = SchedulerService(
+            rule_cache,
+            metrics_json=args.metrics_json,
+            metrics_prom=args.metrics_prom,
+            **slot,
+        )
+        try:
+            asyncio.run(service.serve(args.serve))
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            logger.error("Error: %s", e)
+            return -1
+        return 0
+
+    exdates = parse_exdates(args.exclude_datetimes)
+    try:
+        exclude_calendars = resolve_calendars(args.exclude_calendars)
+    except ValueError as e:
+        parser.error(str(e))
+
+    store = None
+    if args.cache_dir:
+        try:
+            store = OccurrenceStore(args.cache_dir, int(args.cache_max_mb * 2**20))
+        except OSError as e:
+            logger.error("Error: occurrence cache disabled: %s", e)
 
     # Call the check_rrule_in_slot function
-    status = check_rrule_in_slot(args.include_rule, args.exclude_rule, exdates)
-    exit(status)
+    return check_rrule_in_slot(
+        args.include_rule,
+        args.exclude_rule,
+        exdates,
+        calendars=exclude_calendars,
+        store=store,
+        **slot,
+    )
 
 
 if __name__ == "__main__":
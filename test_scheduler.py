@@ -1,9 +1,58 @@
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
-from datetime import datetime
+from datetime import datetime, timedelta
+from dateutil import tz
+from dateutil.rrule import rrulestr
 from dateutil.tz import UTC
 
-from scheduler import check_rrule_in_slot
+from scheduler import (
+    BUDGET_EXCEEDED,
+    BudgetExceeded,
+    CompiledRule,
+    EmptyRuleError,
+    ExclusionCalendar,
+    JobRegistry,
+    Metrics,
+    OccurrenceIndex,
+    OccurrenceStore,
+    RuleCache,
+    SchedulerService,
+    ShardMergeError,
+    SlotIndex,
+    calendars,
+    check_rrule_in_slot,
+    compile_rules,
+    disable_metrics,
+    empty_rule_reason,
+    enable_metrics,
+    evaluate_jobs,
+    evaluate_jobs_parallel,
+    forecast,
+    has_fixed_offset,
+    load_calendar,
+    load_jobs,
+    merge_shards,
+    parse_shard,
+    query,
+    rule_cache,
+    run_forecast,
+    run_jobs_file,
+    select_shard,
+    shard_of,
+    utc_timestamp,
+    zone_table,
+    zone_tables,
+    simple_rule,
+    slot_bounds,
+)
 
 
 class TestScheduler(unittest.TestCase):
@@ -363,5 +412,1801 @@ class TestScheduler(unittest.TestCase):
         self.assertEqual(result, 0)
 
 
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.now = datetime(2024, 10, 26, 6, 10, tzinfo=UTC)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_manifest(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_jsonl_manifest(self):
+        jobs = [
+            {
+                "job_id": "due",
+                "include_rule": "DTSTART;TZID=Europe/Zurich:20241026T081500 RRULE:FREQ=DAILY;COUNT=1",
+            },
+            {
+                "job_id": "excluded",
+                "include_rule": "DTSTART;TZID=Europe/Zurich:20241026T081500 RRULE:FREQ=DAILY;COUNT=1",
+                "exclude_datetimes": ["2024-10-26T06:15:00+00:00"],
+            },
+            {"job_id": "broken", "include_rule": "not a rule"},
+        ]
+        path = self.write_manifest(
+            "jobs.jsonl", "\n".join(json.dumps(job) for job in jobs) + "\n"
+        )
+
+        decisions = list(evaluate_jobs(load_jobs(path), now_utc=self.now))
+
+        self.assertEqual(
+            [d["job_id"] for d in decisions], ["due", "excluded", "broken"]
+        )
+        self.assertEqual([d["status"] for d in decisions], [0, 1, -1])
+        self.assertEqual(
+            {d["slot_start"] for d in decisions}, {"2024-10-26T06:00:00+00:00"}
+        )
+
+    def test_csv_manifest(self):
+        path = self.write_manifest(
+            "jobs.csv",
+            "job_id,include_rule,exclude_rule,exclude_datetimes\n"
+            "a,DTSTART:20241026T061500Z RRULE:FREQ=HOURLY,,\n"
+            "b,DTSTART:20241026T061500Z RRULE:FREQ=HOURLY,,"
+            "2024-10-26T06:15:00+00:00 2024-10-26T07:15:00+00:00\n",
+        )
+
+        decisions = list(evaluate_jobs(load_jobs(path), now_utc=self.now))
+
+        self.assertEqual(
+            [(d["job_id"], d["status"]) for d in decisions], [("a", 0), ("b", 1)]
+        )
+
+    def test_malformed_lines_are_skipped(self):
+        path = self.write_manifest(
+            "jobs.jsonl",
+            '{"job_id": "a", "include_rule": "DTSTART:20241026T061500Z RRULE:FREQ=HOURLY"}\n'
+            "not json\n"
+            '{"include_rule": "DTSTART:20241026T061500Z RRULE:FREQ=HOURLY"}\n',
+        )
+
+        self.assertEqual([job["job_id"] for job in load_jobs(path)], ["a"])
+
+    def test_run_jobs_file_streams_jsonl(self):
+        path = self.write_manifest(
+            "jobs.jsonl",
+            '{"job_id": "a", "include_rule": "DTSTART:20241026T061500Z RRULE:FREQ=HOURLY"}\n',
+        )
+        out = io.StringIO()
+
+        with patch("scheduler.datetime") as mock_datetime:
+            mock_datetime.now.return_value = self.now
+            run_jobs_file(path, out=out)
+
+        self.assertEqual(
+            json.loads(out.getvalue()),
+            {"job_id": "a", "status": 0, "slot_start": "2024-10-26T06:00:00+00:00"},
+        )
+
+
+class TestRuleCache(unittest.TestCase):
+    RULE_A = "DTSTART:20241026T061500Z RRULE:FREQ=HOURLY"
+    RULE_B = "DTSTART:20241026T064500Z RRULE:FREQ=HOURLY"
+    RULE_C = "DTSTART:20241026T070000Z RRULE:FREQ=DAILY"
+
+    def test_hits_and_misses(self):
+        cache = RuleCache(maxsize=2)
+
+        first = cache.get(self.RULE_A)
+        second = cache.get(self.RULE_A)
+
+        self.assertIs(first, second)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_exdates_are_normalized_in_key(self):
+        cache = RuleCache()
+        naive = datetime(2024, 10, 26, 6, 15)
+        aware = datetime(2024, 10, 26, 8, 15, tzinfo=tz.gettz("Europe/Zurich"))
+        other = datetime(2024, 10, 26, 7, 15, tzinfo=UTC)
+
+        first = cache.get(self.RULE_A, exdates=[naive, other])
+        second = cache.get(self.RULE_A, exdates=[other, aware])
+
+        self.assertIs(first, second)
+
+    def test_lru_eviction(self):
+        cache = RuleCache(maxsize=2)
+        a = cache.get(self.RULE_A)
+        cache.get(self.RULE_B)
+        cache.get(self.RULE_A)  # A is now most recently used
+        cache.get(self.RULE_C)  # evicts B
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIs(cache.get(self.RULE_A), a)
+        cache.get(self.RULE_B)
+        self.assertEqual(cache.misses, 4)
+
+    def test_zero_size_disables_cache(self):
+        cache = RuleCache(maxsize=0)
+
+        self.assertIsNot(cache.get(self.RULE_A), cache.get(self.RULE_A))
+        self.assertEqual(len(cache), 0)
+
+    def test_check_uses_given_cache(self):
+        cache = RuleCache()
+        now = datetime(2024, 10, 26, 6, 10, tzinfo=UTC)
+
+        self.assertEqual(check_rrule_in_slot(self.RULE_A, now_utc=now, cache=cache), 0)
+        self.assertEqual(check_rrule_in_slot(self.RULE_A, now_utc=now, cache=cache), 0)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+
+class TestFastForward(unittest.TestCase):
+    # (include rule, exclude rule) pairs with a DTSTART well before the checked times
+    RULES = [
+        (
+            "DTSTART;TZID=Europe/Zurich:20240329T000300 RRULE:FREQ=MINUTELY;INTERVAL=37",
+            None,
+        ),
+        (
+            "DTSTART;TZID=Europe/Zurich:20220101T001500 RRULE:FREQ=HOURLY;INTERVAL=5",
+            None,
+        ),
+        (
+            "DTSTART;TZID=Europe/Zurich:20240101T023000 RRULE:FREQ=HOURLY;BYHOUR=2,3",
+            None,
+        ),
+        ("DTSTART;TZID=Europe/Zurich:20200101T080000 RRULE:FREQ=DAILY", None),
+        (
+            "DTSTART;TZID=Europe/Zurich:20100104T080000 RRULE:FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,SU",
+            None,
+        ),
+        ("DTSTART:20230101T000000Z RRULE:FREQ=HOURLY;COUNT=15000", None),
+        ("DTSTART:20230101T000000Z RRULE:FREQ=HOURLY;COUNT=20000", None),
+        (
+            "DTSTART;TZID=Europe/Zurich:20230101T010000 RRULE:FREQ=HOURLY;BYHOUR=1,2;COUNT=1300",
+            None,
+        ),
+        (
+            "DTSTART;TZID=Europe/Zurich:20240101T001000 RRULE:FREQ=HOURLY;BYMINUTE=0,30;COUNT=15000",
+            None,
+        ),
+        (
+            "DTSTART;TZID=Europe/Zurich:20230101T120000 RRULE:FREQ=DAILY;INTERVAL=3;BYHOUR=1,2,8;BYMINUTE=0,45;COUNT=1328",
+            None,
+        ),
+        (
+            "DTSTART:20240301T000010Z RRULE:FREQ=MINUTELY;INTERVAL=30;BYSECOND=0,30;COUNT=28000",
+            None,
+        ),
+        (
+            "DTSTART;TZID=Europe/Zurich:20200101T080000 RRULE:FREQ=DAILY;UNTIL=20241027T070000Z",
+            None,
+        ),
+        (
+            "DTSTART;TZID=Europe/Zurich:20150101T080000 RRULE:FREQ=DAILY",
+            "DTSTART;TZID=Europe/Zurich:20150101T080000 RRULE:FREQ=DAILY;INTERVAL=2",
+        ),
+    ]
+
+    # Around the Europe/Zurich spring and fall DST transitions and a plain day
+    NOWS = [
+        datetime(2024, 3, 31, 0, 40, tzinfo=UTC),
+        datetime(2024, 3, 31, 1, 10, tzinfo=UTC),
+        datetime(2024, 10, 26, 6, 0, tzinfo=UTC),
+        datetime(2024, 10, 27, 0, 20, tzinfo=UTC),
+        datetime(2024, 10, 27, 1, 5, tzinfo=UTC),
+        datetime(2024, 10, 27, 7, 0, tzinfo=UTC),
+        datetime(2024, 12, 26, 7, 0, tzinfo=UTC),
+    ]
+
+    def test_matches_slow_path(self):
+        for include, exclude in self.RULES:
+            slow = compile_rules(include, exclude)
+            compiled = CompiledRule(compile_rules(include, exclude))
+            for now in self.NOWS:
+                with self.subTest(include=include, exclude=exclude, now=now):
+                    self.assertEqual(
+                        compiled.ruleset_at(now).after(now, inc=True),
+                        slow.after(now, inc=True),
+                    )
+
+    def test_anchor_is_close_to_now(self):
+        compiled = CompiledRule(
+            compile_rules("DTSTART:20150101T000000Z RRULE:FREQ=MINUTELY;INTERVAL=7")
+        )
+        now = datetime(2024, 10, 26, 6, 10, tzinfo=UTC)
+
+        anchored = compiled.ruleset_at(now)
+        rule = anchored._rrule[0]._rrule[0].rule
+
+        self.assertLessEqual(rule._dtstart, now - timedelta(hours=3))
+        self.assertGreater(rule._dtstart, now - timedelta(hours=3, minutes=7))
+
+    def test_count_with_by_parts_is_fast_forwarded(self):
+        compiled = CompiledRule(compile_rules(self.RULES[8][0]))
+        now = datetime(2024, 10, 26, 6, 10, tzinfo=UTC)
+
+        rule = compiled.ruleset_at(now)._rrule[0]._rrule[0].rule
+
+        self.assertGreater(rule._dtstart, now - timedelta(hours=4))
+        self.assertLess(rule._count, 15000)
+
+    def test_reanchors_when_time_goes_backwards(self):
+        compiled = CompiledRule(compile_rules(self.RULES[3][0]))
+        later = datetime(2024, 12, 26, 7, 0, tzinfo=UTC)
+        earlier = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+
+        compiled.ruleset_at(later)
+
+        self.assertEqual(
+            compiled.ruleset_at(earlier).after(earlier, inc=True),
+            datetime(2024, 10, 26, 6, 0, tzinfo=UTC),
+        )
+
+    def test_old_minutely_rule_is_checked_quickly(self):
+        # Walking from DTSTART would iterate several million occurrences
+        rule = "DTSTART:20150101T000000Z RRULE:FREQ=MINUTELY"
+        now = datetime(2024, 10, 26, 6, 10, 30, tzinfo=UTC)
+
+        self.assertEqual(check_rrule_in_slot(rule, now_utc=now, cache=RuleCache()), 0)
+
+
+class TestOccurrenceIndex(unittest.TestCase):
+    RULE = "DTSTART;TZID=Europe/Zurich:20241020T003000 RRULE:FREQ=HOURLY;INTERVAL=5;BYMINUTE=30,50"
+    EXRULE = "DTSTART;TZID=Europe/Zurich:20241020T003000 RRULE:FREQ=DAILY;BYHOUR=10"
+
+    def test_matches_after_across_fall_dst_transition(self):
+        slow = compile_rules(self.RULE, self.EXRULE)
+        compiled = CompiledRule(
+            compile_rules(self.RULE, self.EXRULE), timedelta(days=1)
+        )
+        now = datetime(2024, 10, 25, 0, 0, tzinfo=UTC)
+
+        while now < datetime(2024, 10, 29, tzinfo=UTC):
+            until = now + timedelta(minutes=30)
+            expected = slow.after(now, inc=True)
+            if expected is not None and expected >= until:
+                expected = None
+            found = compiled.index.next_after(now, until=int(until.timestamp()))
+            with self.subTest(now=now):
+                self.assertEqual(
+                    found, None if expected is None else int(expected.timestamp())
+                )
+            now += timedelta(minutes=13)
+
+    def test_occurrences_are_compact_epoch_seconds(self):
+        compiled = CompiledRule(compile_rules(self.RULE), timedelta(days=7))
+        now = datetime(2024, 10, 25, tzinfo=UTC)
+
+        compiled.index.ensure(now, int(now.timestamp()))
+
+        occurrences = compiled.index.occurrences
+        self.assertEqual(occurrences.typecode, "q")
+        self.assertEqual(list(occurrences), sorted(occurrences))
+        expected = compile_rules(self.RULE).between(
+            now, now + timedelta(days=7), inc=True
+        )
+        self.assertEqual(list(occurrences), [int(dt.timestamp()) for dt in expected])
+
+    def test_default_cache_materializes_only_the_slot(self):
+        rule = "DTSTART:20241025T000000Z RRULE:FREQ=SECONDLY"
+        now = datetime(2024, 10, 25, 1, 5, tzinfo=UTC)
+
+        self.assertEqual(check_rrule_in_slot(rule, now_utc=now), 0)
+
+        index = rule_cache.get(rule).index
+        self.assertEqual(
+            index.end, int(datetime(2024, 10, 25, 1, 30, tzinfo=UTC).timestamp())
+        )
+        rule_cache.clear()
+
+    def test_horizon_is_extended_incrementally(self):
+        index = OccurrenceIndex(
+            CompiledRule(compile_rules(self.RULE)), timedelta(days=2)
+        )
+        now = datetime(2024, 10, 25, tzinfo=UTC)
+        calls = []
+        materialize = index._materialize
+
+        def record(start, end, *args):
+            calls.append((start, end))
+            return materialize(start, end, *args)
+
+        with patch.object(index, "_materialize", side_effect=record):
+            index.ensure(now, 0)
+            first_end = index.end
+            index.ensure(now + timedelta(hours=12), 0)
+            index.ensure(now + timedelta(days=1, hours=1), 0)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[1][0], first_end)
+        self.assertEqual(
+            index.start, int((now + timedelta(days=1, hours=1)).timestamp())
+        )
+        self.assertGreaterEqual(index.occurrences[0], index.start)
+
+    def test_rebuilds_when_now_leaves_window(self):
+        compiled = CompiledRule(compile_rules(self.RULE), timedelta(days=1))
+        later = datetime(2024, 12, 1, tzinfo=UTC)
+        earlier = datetime(2024, 10, 25, tzinfo=UTC)
+
+        compiled.index.ensure(later, 0)
+        found = compiled.index.next_after(earlier, int(earlier.timestamp()) + 86400)
+
+        self.assertEqual(
+            found, int(compile_rules(self.RULE).after(earlier).timestamp())
+        )
+
+
+class TestSlotIndex(unittest.TestCase):
+    JOBS = {
+        "hourly": "DTSTART;TZID=Europe/Zurich:20241020T001500 RRULE:FREQ=HOURLY;INTERVAL=3",
+        "daily": "DTSTART;TZID=Europe/Zurich:20241020T080000 RRULE:FREQ=DAILY",
+        "minutely": "DTSTART:20241020T000000Z RRULE:FREQ=MINUTELY;INTERVAL=45",
+        "once": "DTSTART;TZID=Asia/Tokyo:20241027T073000 RRULE:FREQ=DAILY;COUNT=1",
+    }
+
+    def setUp(self):
+        self.cache = RuleCache()
+        self.index = SlotIndex(window=timedelta(days=1))
+        for job_id, rule in self.JOBS.items():
+            self.index.add(job_id, self.cache.get(rule))
+
+    def test_due_matches_check_at_slot_start(self):
+        slot_start = datetime(2024, 10, 26, 0, 0, tzinfo=UTC)
+        while slot_start < datetime(2024, 10, 29, tzinfo=UTC):
+            expected = {
+                job_id
+                for job_id, rule in self.JOBS.items()
+                if check_rrule_in_slot(rule, now_utc=slot_start, cache=self.cache) == 0
+            }
+            with self.subTest(slot_start=slot_start):
+                self.assertEqual(self.index.due(slot_start), expected)
+            slot_start += timedelta(minutes=30)
+
+    def test_mid_slot_lookup_uses_the_containing_slot(self):
+        self.assertEqual(
+            self.index.due(datetime(2024, 10, 26, 6, 20, tzinfo=UTC)),
+            {"daily", "minutely"},
+        )
+
+    def test_remove_and_change_job(self):
+        now = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+        self.assertIn("daily", self.index.due(now))
+
+        self.index.remove("minutely")
+        self.assertTrue(self.index.remove("daily"))
+        self.assertNotIn("daily", self.index.due(now))
+        self.assertFalse(self.index.remove("daily"))
+
+        self.index.add(
+            "hourly",
+            self.cache.get("DTSTART:20241020T000000Z RRULE:FREQ=DAILY;BYHOUR=6"),
+        )
+        self.assertEqual(self.index.due(now), {"hourly"})
+        self.assertEqual(self.index.due(now + timedelta(hours=3)), set())
+
+    def test_job_over_budget_does_not_fail_the_window(self):
+        cache = RuleCache(max_iterations=1000)
+        self.index.add(
+            "secondly", cache.get("DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY")
+        )
+
+        self.assertEqual(
+            self.index.due(datetime(2024, 10, 26, 6, 20, tzinfo=UTC)),
+            {"daily", "minutely"},
+        )
+
+    def test_jobs_are_only_held_in_their_slots(self):
+        now = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+        self.index.due(now)
+        slots = [slot for slot, job_ids in self.index._slots.items() if job_ids]
+
+        self.assertEqual(len(self.index._jobs), 4)
+        self.assertNotIsInstance(self.index._jobs["daily"], tuple)
+        self.index.remove("minutely")
+        self.assertFalse(any("minutely" in self.index._slots[slot] for slot in slots))
+
+        # A job over its budget is looked for in every slot of the window
+        index = SlotIndex(window=timedelta(hours=2))
+        cache = RuleCache(max_iterations=1000)
+        index.add("secondly", cache.get("DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY"))
+        index.due(now)
+        index._slots[index.end - 1].add("secondly")
+        self.assertTrue(index.remove("secondly"))
+        self.assertFalse(any(index._slots.values()))
+
+    def test_default_window_is_hours(self):
+        index = SlotIndex()
+
+        index.due(datetime(2024, 10, 26, 6, 0, tzinfo=UTC))
+
+        self.assertLessEqual(index.end - index.start, 24)
+
+    def test_window_rolls_forward(self):
+        now = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+        self.index.due(now)
+        start = self.index.start
+
+        self.index.due(now + timedelta(hours=13))
+        # 08:00 in Zurich is 07:00 UTC once DST has ended
+        self.assertIn("daily", self.index.due(now + timedelta(days=1, hours=1)))
+        self.assertEqual(self.index.start, start + 26)
+        self.assertFalse(any(slot < self.index.start for slot in self.index._slots))
+
+
+class TestSchedulerService(unittest.TestCase):
+    DAILY = "DTSTART;TZID=Europe/Zurich:20241020T080000 RRULE:FREQ=DAILY"
+
+    def setUp(self):
+        self.service = SchedulerService(window=timedelta(days=1))
+        self.patcher = patch("scheduler.datetime")
+        self.mock_datetime = self.patcher.start()
+        self.mock_datetime.now.return_value = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+        self.mock_datetime.fromisoformat.side_effect = datetime.fromisoformat
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_register_check_due_unregister(self):
+        handle = self.service.handle
+
+        self.assertEqual(
+            handle({"op": "register", "job_id": "a", "include_rule": self.DAILY}),
+            {"ok": True},
+        )
+        handle(
+            {
+                "op": "register",
+                "job_id": "b",
+                "include_rule": self.DAILY,
+                "exclude_datetimes": ["2024-10-26T06:00:00+00:00"],
+            }
+        )
+
+        self.assertEqual(
+            handle({"op": "check", "job_id": "a"}),
+            {"ok": True, "status": 0, "slot_start": "2024-10-26T06:00:00+00:00"},
+        )
+        self.assertEqual(handle({"op": "check", "job_id": "b"})["status"], 1)
+        self.assertEqual(handle({"op": "due"})["job_ids"], ["a"])
+        self.assertEqual(handle({"op": "stats"})["jobs"], 2)
+
+        self.assertEqual(
+            handle({"op": "unregister", "job_id": "a"}), {"ok": True, "removed": True}
+        )
+        self.assertEqual(handle({"op": "due"})["job_ids"], [])
+        self.assertFalse(handle({"op": "check", "job_id": "a"})["ok"])
+
+    def test_errors_are_reported(self):
+        handle = self.service.handle
+
+        self.assertFalse(handle({"op": "nope"})["ok"])
+        self.assertFalse(handle({"op": "register", "job_id": "a"})["ok"])
+        self.assertFalse(
+            handle({"op": "register", "job_id": "a", "include_rule": "garbage"})["ok"]
+        )
+        self.assertEqual(handle({"op": "stats"})["jobs"], 0)
+
+    def test_registration_over_budget_is_rejected(self):
+        service = SchedulerService(RuleCache(max_iterations=5000), timedelta(days=1))
+
+        response = service.handle(
+            {
+                "op": "register",
+                "job_id": "j",
+                "include_rule": "DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY",
+            }
+        )
+
+        self.assertFalse(response["ok"])
+        self.assertIn("5000 iterations", response["error"])
+        self.assertNotIn("j", service.jobs)
+        self.assertNotIn("j", service.slots)
+
+    def test_memory_includes_the_slot_index(self):
+        minutely = "DTSTART:20241026T000000Z RRULE:FREQ=MINUTELY"
+        for i in range(200):
+            self.service.register(f"job-{i}", minutely)
+
+        memory = self.service.handle({"op": "stats"})["memory"]
+
+        # 200 jobs in each of the day's 48 slots
+        self.assertGreater(
+            memory["bytes"] - self.service.jobs.footprint()["bytes"], 48 * 200 * 8
+        )
+        self.assertEqual(
+            memory["bytes"],
+            self.service.jobs.footprint()["bytes"] + self.service.slots.footprint(),
+        )
+
+    def test_failed_reregistration_keeps_the_job(self):
+        service = SchedulerService(RuleCache(max_iterations=5000), timedelta(days=1))
+        service.register("j", self.DAILY)
+        self.assertEqual(service.due(), ["j"])
+
+        # A day of secondly occurrences is over the budget of the slot window
+        response = service.handle(
+            {
+                "op": "register",
+                "job_id": "j",
+                "include_rule": "DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY",
+            }
+        )
+
+        self.assertFalse(response["ok"])
+        self.assertIn("j", service.jobs)
+        self.assertEqual(service.check("j"), 0)
+        self.assertEqual(service.due(), ["j"])
+        self.assertEqual(service.jobs.footprint()["rules"], 1)
+
+
+class TestSchedulerServiceSocket(unittest.IsolatedAsyncioTestCase):
+    async def test_round_trip_over_unix_socket(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "scheduler.sock")
+            service = SchedulerService(window=timedelta(days=1))
+            server = asyncio.create_task(service.serve(path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+
+            reader, writer = await asyncio.open_unix_connection(path)
+            rule = "DTSTART:20200101T000000Z RRULE:FREQ=MINUTELY"
+            for request in (
+                {"op": "register", "job_id": "a", "include_rule": rule},
+                {"op": "stats"},
+            ):
+                writer.write(json.dumps(request).encode() + b"\n")
+            writer.write(b"not json\n")
+            await writer.drain()
+
+            # The slot index was built at startup, so registering indexed the job
+            self.assertEqual(json.loads(await reader.readline()), {"ok": True})
+            self.assertIsNotNone(service.slots.start)
+            self.assertIn("a", service.slots._slots[service.slots.start])
+            self.assertEqual(json.loads(await reader.readline())["jobs"], 1)
+            self.assertFalse(json.loads(await reader.readline())["ok"])
+            writer.close()
+
+            response = await asyncio.to_thread(query, path, {"op": "due"})
+            self.assertEqual(response["ok"], True)
+
+            server.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await server
+
+    async def test_large_and_overlong_requests(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "scheduler.sock")
+            service = SchedulerService(window=timedelta(days=1))
+            with patch("scheduler.MAX_REQUEST_BYTES", 256 * 1024):
+                server = asyncio.create_task(service.serve(path))
+                while not os.path.exists(path):
+                    await asyncio.sleep(0.01)
+
+            # Well over asyncio's default 64 KiB line limit
+            start = datetime(2030, 1, 1, tzinfo=UTC)
+            request = {
+                "op": "register",
+                "job_id": "a",
+                "include_rule": "DTSTART:20200101T000000Z RRULE:FREQ=HOURLY",
+                "exclude_datetimes": [
+                    (start + timedelta(hours=i)).isoformat() for i in range(3000)
+                ],
+            }
+            response = await asyncio.to_thread(query, path, request)
+            self.assertEqual(response, {"ok": True})
+
+            request["exclude_datetimes"] *= 4
+            response = await asyncio.to_thread(query, path, request)
+            self.assertFalse(response["ok"])
+            self.assertIn("invalid request", response["error"])
+
+            server.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await server
+
+    async def test_live_socket_is_not_taken_over(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "scheduler.sock")
+            service = SchedulerService(window=timedelta(days=1))
+            server = asyncio.create_task(service.serve(path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+
+            with self.assertRaises(OSError):
+                await asyncio.wait_for(SchedulerService().serve(path), 5)
+            response = await asyncio.to_thread(query, path, {"op": "stats"})
+            self.assertEqual(response["ok"], True)
+
+            server.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await server
+
+            # Once nothing listens on it, the stale socket is replaced
+            server = asyncio.create_task(SchedulerService().serve(path))
+            response = None
+            while response is None:
+                await asyncio.sleep(0.01)
+                try:
+                    response = await asyncio.to_thread(query, path, {"op": "stats"})
+                except (ConnectionRefusedError, FileNotFoundError):
+                    pass
+            self.assertEqual(response["ok"], True)
+
+            server.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await server
+
+
+class TestSlotWidth(unittest.TestCase):
+    def test_slot_width_must_be_whole_seconds(self):
+        now = datetime(2024, 10, 26, 6, 44, tzinfo=UTC)
+        rule = "DTSTART:20241026T000000Z RRULE:FREQ=MINUTELY"
+        for width in (timedelta(0), timedelta(minutes=-5), timedelta(seconds=1.5)):
+            with self.subTest(width=width):
+                with self.assertRaises(ValueError):
+                    slot_bounds(now, width)
+                with self.assertRaises(ValueError):
+                    SlotIndex(slot_width=width)
+                with self.assertRaises(ValueError):
+                    check_rrule_in_slot(rule, now_utc=now, slot_width=width)
+        with self.assertRaises(ValueError):
+            slot_bounds(now, slot_offset=timedelta(milliseconds=500))
+
+    def test_default_slot_bounds(self):
+        now = datetime(2024, 10, 26, 6, 44, 59, 999, tzinfo=UTC)
+
+        self.assertEqual(
+            slot_bounds(now),
+            (
+                datetime(2024, 10, 26, 6, 30, tzinfo=UTC),
+                datetime(2024, 10, 26, 7, 0, tzinfo=UTC),
+            ),
+        )
+
+    def test_custom_width_and_offset(self):
+        now = datetime(2024, 10, 26, 6, 4, tzinfo=UTC)
+
+        self.assertEqual(
+            slot_bounds(now, timedelta(minutes=20), timedelta(minutes=5)),
+            (
+                datetime(2024, 10, 26, 5, 45, tzinfo=UTC),
+                datetime(2024, 10, 26, 6, 5, tzinfo=UTC),
+            ),
+        )
+
+    def test_check_with_custom_slot(self):
+        rule = "DTSTART;TZID=Asia/Tokyo:20241001T081200 RRULE:FREQ=DAILY;COUNT=1"
+        now = datetime(2024, 9, 30, 23, 6, tzinfo=UTC)
+        cache = RuleCache()
+
+        self.assertEqual(check_rrule_in_slot(rule, now_utc=now, cache=cache), 0)
+        self.assertEqual(
+            check_rrule_in_slot(
+                rule, now_utc=now, cache=cache, slot_width=timedelta(minutes=10)
+            ),
+            1,
+        )
+        self.assertEqual(
+            check_rrule_in_slot(
+                rule,
+                now_utc=now,
+                cache=cache,
+                slot_width=timedelta(minutes=10),
+                slot_offset=timedelta(minutes=5),
+            ),
+            0,
+        )
+
+
+class TestForecast(unittest.TestCase):
+    JOBS = [
+        {
+            "job_id": "daily",
+            "include_rule": "DTSTART;TZID=Europe/Zurich:20240101T080000 RRULE:FREQ=DAILY",
+            "exclude_datetimes": ["2024-10-27T07:00:00+00:00"],
+        },
+        {
+            "job_id": "dense",
+            "include_rule": "DTSTART:20241026T000000Z RRULE:FREQ=MINUTELY;INTERVAL=50",
+        },
+        {
+            "job_id": "gap",
+            "include_rule": "DTSTART;TZID=Europe/Zurich:20240101T020000 RRULE:FREQ=HOURLY;BYHOUR=2",
+            "exclude_rule": "DTSTART;TZID=Europe/Zurich:20240101T020000 RRULE:FREQ=WEEKLY",
+        },
+        {"job_id": "broken", "include_rule": "garbage"},
+    ]
+
+    def test_matches_check_at_every_slot_start(self):
+        start = datetime(2024, 10, 26, 0, 0, tzinfo=UTC)
+        end = datetime(2024, 10, 28, 0, 0, tzinfo=UTC)
+        width = timedelta(minutes=45)
+        cache = RuleCache()
+
+        decisions = list(forecast(self.JOBS, start, end, slot_width=width))
+
+        expected = []
+        slot_start = start
+        while slot_start < end:
+            for job in self.JOBS:
+                status = check_rrule_in_slot(
+                    job["include_rule"],
+                    job.get("exclude_rule"),
+                    [
+                        datetime.fromisoformat(d)
+                        for d in job.get("exclude_datetimes", [])
+                    ],
+                    now_utc=slot_start,
+                    cache=cache,
+                    slot_width=width,
+                )
+                if status == 0:
+                    expected.append((slot_start, job["job_id"]))
+            slot_start += width
+        self.assertEqual(decisions, expected)
+        self.assertIn((datetime(2024, 10, 27, 6, 45, tzinfo=UTC), "dense"), decisions)
+        self.assertNotIn(
+            (datetime(2024, 10, 27, 6, 45, tzinfo=UTC), "daily"), decisions
+        )
+
+    def test_range_covers_slots_starting_inside_it(self):
+        decisions = forecast(
+            self.JOBS[1:2],
+            datetime(2024, 10, 26, 0, 10, tzinfo=UTC),
+            datetime(2024, 10, 26, 2, 30, tzinfo=UTC),
+        )
+
+        self.assertEqual(
+            [slot_start.strftime("%H:%M") for slot_start, _ in decisions],
+            ["00:30", "01:30"],
+        )
+
+    def test_replays_the_past_lazily(self):
+        decisions = forecast(
+            self.JOBS[:1],
+            datetime(2020, 1, 1, tzinfo=UTC),
+            datetime(2030, 1, 1, tzinfo=UTC),
+        )
+
+        self.assertEqual(
+            next(decisions), (datetime(2024, 1, 1, 7, 0, tzinfo=UTC), "daily")
+        )
+
+    def test_jobs_that_stop_early_are_reported(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "jobs.jsonl")
+            with open(path, "w") as f:
+                f.writelines(json.dumps(job) + "\n" for job in self.JOBS[1:])
+            out = io.StringIO()
+
+            failed = run_forecast(
+                path,
+                datetime(2024, 10, 26, 0, 0, tzinfo=UTC),
+                datetime(2024, 10, 26, 2, 0, tzinfo=UTC),
+                out=out,
+            )
+
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(failed, 1)
+        self.assertEqual(lines[0]["job_id"], "broken")
+        self.assertIn("error", lines[0])
+        self.assertEqual({line["job_id"] for line in lines[1:]}, {"dense", "gap"})
+
+
+class TestExclusionCalendar(unittest.TestCase):
+    RULE = "DTSTART;TZID=Europe/Zurich:20241020T080000 RRULE:FREQ=DAILY"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(calendars.clear)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_plain_list(self):
+        path = self.write(
+            "holidays.txt",
+            "# company holidays\n"
+            "2024-12-25T07:00:00Z\n"
+            "\n"
+            "2024-12-26T08:00:00+01:00  # boxing day\n"
+            "2024-12-31T07:00:00\n",
+        )
+
+        calendar = ExclusionCalendar.from_file("holidays", path)
+
+        self.assertEqual(
+            calendar.timestamps,
+            {
+                datetime(2024, 12, 25, 7, tzinfo=UTC).timestamp(),
+                datetime(2024, 12, 26, 7, tzinfo=UTC).timestamp(),
+                datetime(2024, 12, 31, 7, tzinfo=UTC).timestamp(),
+            },
+        )
+
+    def test_icalendar(self):
+        path = self.write(
+            "maintenance.ics",
+            "BEGIN:VCALENDAR\r\n"
+            "VERSION:2.0\r\n"
+            "BEGIN:VEVENT\r\n"
+            "DTSTART;TZID=Europe/Zurich:20241027T080000\r\n"
+            "DTEND;TZID=Europe/Zurich:20241027T090000\r\n"
+            "EXDATE;TZID=Europe/Zurich:20241028T080000,\r\n"
+            " 20241029T080000\r\n"
+            "END:VEVENT\r\n"
+            "BEGIN:VTODO\r\n"
+            "DTSTART:20241030T070000Z\r\n"
+            "END:VTODO\r\n"
+            "EXDATE:20241031T070000Z\r\n"
+            "END:VCALENDAR\r\n",
+        )
+
+        calendar = ExclusionCalendar.from_file("maintenance", path)
+
+        self.assertEqual(
+            sorted(
+                datetime.fromtimestamp(ts, UTC).strftime("%d %H:%M")
+                for ts in calendar.timestamps
+            ),
+            ["28 07:00", "29 07:00", "31 07:00"],
+        )
+        # The event covers 08:00 up to 09:00 in Zurich
+        event = datetime(2024, 10, 27, 7, tzinfo=UTC).timestamp()
+        self.assertIn(event, calendar)
+        self.assertIn(event + 3599, calendar)
+        self.assertNotIn(event + 3600, calendar)
+
+    def test_all_day_events_exclude_the_whole_day(self):
+        path = self.write(
+            "holidays.ics",
+            "BEGIN:VCALENDAR\r\n"
+            "BEGIN:VEVENT\r\n"
+            "SUMMARY:Christmas\r\n"
+            "DTSTART;VALUE=DATE:20241225\r\n"
+            "END:VEVENT\r\n"
+            "BEGIN:VEVENT\r\n"
+            "DTSTART;VALUE=DATE:20241231\r\n"
+            "DTEND;VALUE=DATE:20250102\r\n"
+            "END:VEVENT\r\n"
+            "BEGIN:VEVENT\r\n"
+            "DTSTART:20241227T060000Z\r\n"
+            "DURATION:PT2H\r\n"
+            "END:VEVENT\r\n"
+            "EXDATE;VALUE=DATE:20241229\r\n"
+            "END:VCALENDAR\r\n",
+        )
+        calendar = ExclusionCalendar.from_file("holidays", path)
+        plain = ExclusionCalendar.from_file(
+            "holidays", self.write("holidays.txt", "2024-12-25\n")
+        )
+        cache = RuleCache()
+
+        # The job runs at 07:00 UTC in winter
+        for day, expected in (
+            (24, 0),
+            (25, 1),
+            (26, 0),
+            (27, 1),
+            (29, 1),
+            (31, 1),
+            (32, 1),
+            (33, 0),
+        ):
+            now = datetime(2024, 12, 1, 7, tzinfo=UTC) + timedelta(days=day - 1)
+            with self.subTest(now=now):
+                status = check_rrule_in_slot(
+                    self.RULE, now_utc=now, cache=cache, calendars=[calendar]
+                )
+                self.assertEqual(status, expected)
+        self.assertEqual(
+            check_rrule_in_slot(
+                self.RULE,
+                now_utc=datetime(2024, 12, 25, 7, tzinfo=UTC),
+                cache=cache,
+                calendars=[plain],
+            ),
+            1,
+        )
+        self.assertNotEqual(calendar.digest, plain.digest)
+
+    def test_check_skips_calendar_dates(self):
+        calendar = ExclusionCalendar(
+            "holidays", [datetime(2024, 10, 26, 6, 0, tzinfo=UTC)]
+        )
+        cache = RuleCache()
+
+        for now, expected in (
+            (datetime(2024, 10, 25, 6, 0, tzinfo=UTC), 0),
+            (datetime(2024, 10, 26, 6, 0, tzinfo=UTC), 1),
+            (datetime(2024, 10, 27, 7, 0, tzinfo=UTC), 0),
+        ):
+            with self.subTest(now=now):
+                status = check_rrule_in_slot(
+                    self.RULE, now_utc=now, cache=cache, calendars=[calendar]
+                )
+                self.assertEqual(status, expected)
+
+    def test_calendar_is_shared_not_copied(self):
+        calendar = ExclusionCalendar(
+            "holidays", [datetime(2024, 10, 26, 6, tzinfo=UTC)]
+        )
+        cache = RuleCache()
+
+        first = cache.get(self.RULE, calendars=[calendar])
+        second = cache.get(self.RULE.replace("080000", "090000"), calendars=[calendar])
+
+        self.assertIs(first.calendars[0], second.calendars[0])
+
+    def test_manifest_references_calendar_by_name(self):
+        load_calendar("holidays", self.write("holidays.txt", "2024-10-26T06:00:00Z\n"))
+        jobs = [
+            {"job_id": "plain", "include_rule": self.RULE},
+            {"job_id": "holiday", "include_rule": self.RULE, "calendars": ["holidays"]},
+            {"job_id": "unknown", "include_rule": self.RULE, "calendars": ["nope"]},
+        ]
+
+        decisions = evaluate_jobs(
+            jobs, now_utc=datetime(2024, 10, 26, 6, 0, tzinfo=UTC), cache=RuleCache()
+        )
+
+        self.assertEqual([d["status"] for d in decisions], [0, 1, -1])
+
+
+class TestBoundedEvaluation(unittest.TestCase):
+    NOW = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+
+    def reason(self, rule_str):
+        return empty_rule_reason(rrulestr(rule_str))
+
+    def test_provably_empty_rules(self):
+        for rule_str in (
+            "DTSTART:20240101T000000Z RRULE:FREQ=DAILY;BYMONTH=2;BYMONTHDAY=30",
+            "DTSTART:20240101T000000Z RRULE:FREQ=YEARLY;BYMONTH=4,6;BYMONTHDAY=31,-31",
+            "DTSTART:20240131T000000Z RRULE:FREQ=MONTHLY;BYMONTH=2",
+            "DTSTART:20240101T000000Z RRULE:FREQ=YEARLY;BYMONTH=3;BYYEARDAY=1,-1",
+            "DTSTART:20240101T000000Z RRULE:FREQ=DAILY;COUNT=0",
+            "DTSTART:20240101T000000Z RRULE:FREQ=DAILY;UNTIL=20231231T000000Z",
+            "DTSTART:20240101T000000Z RRULE:FREQ=HOURLY;BYWEEKNO=1;BYMONTH=6",
+            "DTSTART:20240101T000000Z RRULE:FREQ=YEARLY;BYWEEKNO=26,-1;BYMONTH=3",
+        ):
+            with self.subTest(rule=rule_str):
+                self.assertIsNotNone(self.reason(rule_str))
+
+    def test_possible_rules(self):
+        for rule_str in (
+            "DTSTART:20240101T000000Z RRULE:FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=29",
+            "DTSTART:20240101T000000Z RRULE:FREQ=MONTHLY;BYMONTHDAY=-1",
+            "DTSTART:20240131T000000Z RRULE:FREQ=MONTHLY",
+            "DTSTART:20240101T000000Z RRULE:FREQ=YEARLY;BYMONTH=3;BYYEARDAY=60",
+            "DTSTART:20240101T000000Z RRULE:FREQ=MONTHLY;BYDAY=5MO",
+            "DTSTART:20240101T000000Z RRULE:FREQ=DAILY;BYWEEKNO=1;BYMONTH=12",
+            "DTSTART:20240101T000000Z RRULE:FREQ=YEARLY;BYWEEKNO=-1;BYMONTH=1",
+            "DTSTART:20240101T000000Z RRULE:FREQ=YEARLY;BYWEEKNO=26;WKST=SU;BYMONTH=7",
+        ):
+            with self.subTest(rule=rule_str):
+                self.assertIsNone(self.reason(rule_str))
+
+    def test_empty_rules_are_rejected_when_compiled(self):
+        rule_str = "DTSTART:20240101T000000Z RRULE:FREQ=DAILY;BYMONTH=2;BYMONTHDAY=30"
+
+        with self.assertRaises(EmptyRuleError):
+            RuleCache().get(rule_str)
+        self.assertEqual(
+            check_rrule_in_slot(rule_str, now_utc=self.NOW, cache=RuleCache()), -1
+        )
+        service = SchedulerService()
+        response = service.handle(
+            {"op": "register", "job_id": "a", "include_rule": rule_str}
+        )
+        self.assertFalse(response["ok"])
+        self.assertIn("never match", response["error"])
+
+    def test_zero_interval_is_rejected(self):
+        # Fixed-period frequencies used to divide by zero when fast-forwarded,
+        # and calendar ones to walk until the budget ran out
+        for freq in ("SECONDLY", "HOURLY", "WEEKLY", "MONTHLY", "YEARLY"):
+            rule_str = f"DTSTART:20240101T000000Z RRULE:FREQ={freq};INTERVAL=0"
+            with self.subTest(freq=freq):
+                with self.assertRaisesRegex(EmptyRuleError, "INTERVAL"):
+                    RuleCache().get(rule_str)
+                status = check_rrule_in_slot(
+                    rule_str, now_utc=self.NOW, cache=RuleCache()
+                )
+                self.assertEqual(status, -1)
+
+    def test_empty_exclusion_rules_exclude_nothing(self):
+        rule_str = "DTSTART:20241001T061500Z RRULE:FREQ=DAILY"
+        exrule_str = (
+            "DTSTART:20241001T061500Z RRULE:FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=30"
+        )
+        now = datetime(2024, 10, 26, 6, 10, tzinfo=UTC)
+
+        status = check_rrule_in_slot(
+            rule_str, exrule_str, now_utc=now, cache=RuleCache()
+        )
+
+        self.assertEqual(status, 0)
+
+    def test_dense_exrule_exceeds_iteration_budget(self):
+        # Every occurrence is excluded, so the search would never end
+        rule_str = "DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY"
+        cache = RuleCache(max_iterations=10_000)
+
+        status = check_rrule_in_slot(rule_str, rule_str, now_utc=self.NOW, cache=cache)
+
+        self.assertEqual(status, BUDGET_EXCEEDED)
+
+    def test_time_budget(self):
+        rule_str = "DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY"
+        cache = RuleCache(max_seconds=0)
+
+        status = check_rrule_in_slot(rule_str, rule_str, now_utc=self.NOW, cache=cache)
+
+        self.assertEqual(status, BUDGET_EXCEEDED)
+
+    def test_rules_that_never_yield_are_bounded(self):
+        # dateutil would walk these up to year 9999 without yielding anything
+        for rule in (
+            "FREQ=MONTHLY;BYMONTHDAY=1;BYSETPOS=2",
+            "FREQ=DAILY;BYWEEKNO=1;BYMONTH=1;BYMONTHDAY=15",
+        ):
+            rule_str = f"DTSTART:20240101T000000Z RRULE:{rule}"
+            for horizon in (timedelta(0), timedelta(days=7)):
+                cache = RuleCache(horizon=horizon, max_seconds=0.5)
+                with self.subTest(rule=rule, horizon=horizon):
+                    start = time.monotonic()
+                    status = check_rrule_in_slot(
+                        rule_str, now_utc=self.NOW, cache=cache
+                    )
+                    self.assertLess(time.monotonic() - start, 0.5)
+                    self.assertEqual(status, 1)
+
+        # Over a range too long to walk, the time budget stops the walk
+        compiled = RuleCache(max_seconds=0.2).get(rule_str)
+        end = int(datetime(9000, 1, 1, tzinfo=UTC).timestamp())
+        start = time.monotonic()
+        with self.assertRaises(BudgetExceeded):
+            list(compiled.occurrences(self.NOW, self.NOW, end=end))
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_budget_cuts_the_horizon_short(self):
+        # A day of minutely occurrences is well over the budget in total, but the
+        # slot itself fits in it
+        rule_str = "DTSTART:20241020T000000Z RRULE:FREQ=MINUTELY"
+        cache = RuleCache(horizon=timedelta(days=1), max_iterations=500)
+
+        status = check_rrule_in_slot(rule_str, now_utc=self.NOW, cache=cache)
+
+        self.assertEqual(status, 0)
+        index = cache.get(rule_str).index
+        self.assertGreaterEqual(index.end, int(self.NOW.timestamp()) + 1800)
+        self.assertLess(index.end, int(self.NOW.timestamp()) + 500 * 60)
+
+        # Later checks inside the window still answer when extending it runs out
+        later = self.NOW + timedelta(minutes=1)
+        self.assertEqual(check_rrule_in_slot(rule_str, now_utc=later, cache=cache), 0)
+
+    def test_budget_covers_the_whole_materialization(self):
+        # The budget runs out well before the end of the slot, but only after the
+        # next occurrence is known, so that still answers the check. The walk
+        # starts three hours before now, 10,800 occurrences earlier.
+        rule_str = "DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY"
+        cache = RuleCache(max_iterations=12_000)
+
+        status = check_rrule_in_slot(rule_str, now_utc=self.NOW, cache=cache)
+
+        self.assertEqual(status, 0)
+        index = cache.get(rule_str).index
+        self.assertEqual(index.occurrences[0], int(self.NOW.timestamp()))
+        self.assertLess(index.end, int(self.NOW.timestamp()) + 1800)
+
+        # An occurrence after the slot found before the budget runs out still
+        # answers "not in this slot"
+        rule_str = "DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY;BYMINUTE=59"
+        cache = RuleCache(max_iterations=300)
+        status = check_rrule_in_slot(rule_str, now_utc=self.NOW, cache=cache)
+        self.assertEqual(status, 1)
+
+    def test_budget_without_next_occurrence_fails_the_slot(self):
+        # The registry's shared index stops short of the slot end, and the job's
+        # exdates exclude every occurrence it holds
+        rule_str = "DTSTART:20241026T000000Z RRULE:FREQ=SECONDLY"
+        registry = JobRegistry(RuleCache(max_iterations=12_000))
+        exdates = [self.NOW + timedelta(seconds=s) for s in range(1200)]
+        registry.add("a", rule_str, exdates=exdates)
+
+        self.assertEqual(registry.check("a", self.NOW), BUDGET_EXCEEDED)
+
+
+class TestMetrics(unittest.TestCase):
+    NOW = datetime(2024, 10, 28, 10, 5, tzinfo=UTC)
+    RULE = "DTSTART:20241028T000000Z RRULE:FREQ=HOURLY;BYMINUTE=15"
+
+    def tearDown(self):
+        disable_metrics()
+
+    def test_histogram_buckets_are_cumulative(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 2.0):
+            metrics.observe("parse", seconds)
+
+        parse = metrics.to_dict()["phases"]["parse"]
+
+        self.assertEqual(parse["count"], 4)
+        self.assertAlmostEqual(parse["sum"], 2.65)
+        self.assertEqual(parse["buckets"], {"0.1": 2, "1.0": 3, "+Inf": 4})
+
+    def test_prometheus_text(self):
+        metrics = Metrics(buckets=(0.1,))
+        metrics.observe("check", 0.25)
+        metrics.count("checks", 2)
+
+        text = metrics.to_prometheus()
+
+        self.assertIn("# TYPE slot_scheduler_phase_seconds histogram\n", text)
+        self.assertIn(
+            'slot_scheduler_phase_seconds_bucket{phase="check",le="0.1"} 0\n', text
+        )
+        self.assertIn(
+            'slot_scheduler_phase_seconds_bucket{phase="check",le="+Inf"} 1\n', text
+        )
+        self.assertIn('slot_scheduler_phase_seconds_sum{phase="check"} 0.25\n', text)
+        self.assertIn('slot_scheduler_phase_seconds_count{phase="check"} 1\n', text)
+        self.assertIn("# TYPE slot_scheduler_checks_total counter\n", text)
+        self.assertIn("slot_scheduler_checks_total 2\n", text)
+
+    def test_check_records_phases_and_counters(self):
+        metrics = enable_metrics()
+        cache = RuleCache()
+        exdates = [datetime(2024, 10, 28, 9, 15, tzinfo=UTC)]
+
+        for _ in range(2):
+            check_rrule_in_slot(self.RULE, None, exdates, now_utc=self.NOW, cache=cache)
+
+        phases = metrics.to_dict()["phases"]
+        for phase in ("check", "exdates", "parse", "materialize", "tz", "lookup"):
+            self.assertIn(phase, phases)
+        self.assertEqual(phases["check"]["count"], 2)
+        self.assertEqual(phases["parse"]["count"], 1)
+        self.assertEqual(metrics.counters["checks"], 2)
+        self.assertEqual(metrics.counters["cache_hits"], 1)
+        self.assertEqual(metrics.counters["cache_misses"], 1)
+        self.assertGreater(metrics.counters["occurrences_iterated"], 0)
+
+    def test_jobs_evaluated(self):
+        metrics = enable_metrics()
+        jobs = [{"job_id": str(i), "include_rule": self.RULE} for i in range(3)]
+
+        list(evaluate_jobs(jobs, now_utc=self.NOW, cache=RuleCache()))
+
+        self.assertEqual(metrics.counters["jobs_evaluated"], 3)
+
+    def test_disabled_records_nothing(self):
+        metrics = Metrics()
+        check_rrule_in_slot(self.RULE, now_utc=self.NOW, cache=RuleCache())
+
+        self.assertEqual(metrics.to_dict(), {"phases": {}, "counters": {}})
+
+    def test_write_files(self):
+        metrics = Metrics()
+        metrics.observe("check", 0.001)
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, "stats.json")
+            prom_path = os.path.join(tmp, "scheduler.prom")
+            metrics.write_json(json_path)
+            metrics.write_prometheus(prom_path)
+
+            with open(json_path) as f:
+                self.assertEqual(json.load(f), metrics.to_dict())
+            with open(prom_path) as f:
+                self.assertEqual(f.read(), metrics.to_prometheus())
+            self.assertEqual(sorted(os.listdir(tmp)), ["scheduler.prom", "stats.json"])
+
+
+class TestSimpleRuleFastPath(unittest.TestCase):
+    RULES = [
+        "DTSTART:20241027T000000Z RRULE:FREQ=MINUTELY;INTERVAL=7",
+        "DTSTART:20241027T000030Z RRULE:FREQ=MINUTELY;INTERVAL=45",
+        "DTSTART:20241027T001500Z RRULE:FREQ=HOURLY;INTERVAL=5",
+        "DTSTART:20241027T001500Z RRULE:FREQ=HOURLY;COUNT=20",
+        "DTSTART:20241027T000000Z RRULE:FREQ=MINUTELY;INTERVAL=10;"
+        "UNTIL=20241028T120000Z",
+        "DTSTART:20241026T231000+0530 RRULE:FREQ=DAILY",
+        "DTSTART:20241027T094500-0330 RRULE:FREQ=DAILY;INTERVAL=2",
+        "DTSTART;TZID=UTC:20241028T060000 RRULE:FREQ=HOURLY;INTERVAL=3",
+        "DTSTART:20241029T000000Z RRULE:FREQ=MINUTELY;INTERVAL=30",
+        # Not simple, so evaluated by the general path in the same batch
+        "DTSTART:20241027T000000Z RRULE:FREQ=HOURLY;BYMINUTE=5,50",
+        "DTSTART;TZID=Europe/Zurich:20241027T013000 RRULE:FREQ=HOURLY",
+        "not a rule",
+        "DTSTART:20240101T000000Z RRULE:FREQ=HOURLY;INTERVAL=0",
+    ]
+
+    def jobs(self):
+        return [
+            {"job_id": str(i), "include_rule": rule}
+            for i, rule in enumerate(self.RULES)
+        ]
+
+    def test_classification(self):
+        self.assertEqual(
+            simple_rule("DTSTART:20241027T001500Z RRULE:FREQ=HOURLY;INTERVAL=5"),
+            (1729988100, 18000, 2**63 - 1, 2**63 - 1),
+        )
+        self.assertEqual(
+            simple_rule(
+                "DTSTART:20241027T000000+0100 RRULE:FREQ=DAILY;UNTIL=20241030T000000Z"
+            ),
+            (1729983600, 86400, 2**63 - 1, 1730246400),
+        )
+        for rule in self.RULES[9:] + [
+            "DTSTART:20241027T000000Z RRULE:FREQ=WEEKLY",
+            "DTSTART:20241027T000000 RRULE:FREQ=HOURLY",
+            "DTSTART:20241027T000000Z RRULE:FREQ=HOURLY;COUNT=0",
+            "DTSTART:20241027T000000Z\nRRULE:FREQ=HOURLY\nEXDATE:20241027T010000Z",
+            None,
+        ]:
+            with self.subTest(rule=rule):
+                self.assertIsNone(simple_rule(rule))
+
+    def test_fixed_offsets(self):
+        self.assertTrue(has_fixed_offset(UTC))
+        self.assertTrue(has_fixed_offset(tz.tzoffset(None, 19800)))
+        self.assertTrue(has_fixed_offset(tz.gettz("Etc/GMT-5")))
+        self.assertFalse(has_fixed_offset(tz.gettz("Europe/Zurich")))
+        self.assertFalse(has_fixed_offset(None))
+
+    def test_matches_general_path(self):
+        # Every 13 minutes across two days, both slot edges and DST included
+        cache = RuleCache()
+        start = datetime(2024, 10, 27, 0, 0, 30, tzinfo=UTC)
+        for step in range(0, 48 * 60, 13):
+            now_utc = start + timedelta(minutes=step)
+            with self.subTest(now_utc=now_utc):
+                fast = list(evaluate_jobs(self.jobs(), now_utc, cache, batch_size=5))
+                general = list(
+                    evaluate_jobs(self.jobs(), now_utc, cache, fast_path=False)
+                )
+                self.assertEqual(fast, general)
+
+    def test_matches_without_numpy(self):
+        now_utc = datetime(2024, 10, 28, 12, 5, tzinfo=UTC)
+        cache = RuleCache()
+        fast = list(evaluate_jobs(self.jobs(), now_utc, cache))
+        with patch("scheduler.np", None):
+            fallback = list(evaluate_jobs(self.jobs(), now_utc, cache))
+
+        self.assertEqual(fast, fallback)
+        self.assertEqual(
+            [result["status"] for result in fast],
+            [0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, -1, -1],
+        )
+
+    def test_non_string_rules_are_errors(self):
+        jobs = [
+            {"job_id": "list", "include_rule": ["DTSTART:20241028T000000Z"]},
+            {"job_id": "dict", "include_rule": {"freq": "HOURLY"}},
+            {"job_id": "ok", "include_rule": self.RULES[0]},
+        ]
+        now_utc = datetime(2024, 10, 28, 12, 5, tzinfo=UTC)
+
+        results = list(evaluate_jobs(jobs, now_utc, RuleCache()))
+
+        self.assertEqual([result["status"] for result in results], [-1, -1, 0])
+
+    def test_exclusions_use_general_path(self):
+        rule = "DTSTART:20241028T000000Z RRULE:FREQ=MINUTELY;INTERVAL=30"
+        jobs = [
+            {"job_id": "a", "include_rule": rule},
+            {
+                "job_id": "b",
+                "include_rule": rule,
+                "exclude_datetimes": ["2024-10-28T12:00:00+00:00"],
+            },
+        ]
+        now_utc = datetime(2024, 10, 28, 12, 0, tzinfo=UTC)
+
+        results = list(evaluate_jobs(jobs, now_utc, RuleCache()))
+
+        self.assertEqual([result["status"] for result in results], [0, 1])
+
+
+class TestParallelEvaluation(unittest.TestCase):
+    NOW = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+    RULES = [
+        "DTSTART:20241026T000000Z RRULE:FREQ=MINUTELY;INTERVAL=20",
+        "DTSTART;TZID=Europe/Zurich:20241020T080000 RRULE:FREQ=DAILY",
+        "DTSTART:20241026T000000Z RRULE:FREQ=HOURLY;BYMINUTE=45",
+        "not a rule",
+    ]
+
+    def setUp(self):
+        self.addCleanup(calendars.clear)
+        calendars["holidays"] = ExclusionCalendar(
+            "holidays", [datetime(2024, 10, 26, 6, 0, tzinfo=UTC)]
+        )
+        self.jobs = [
+            {
+                "job_id": f"job-{i}",
+                "include_rule": self.RULES[i % len(self.RULES)],
+                "calendars": ["holidays"] if i % 3 == 0 else [],
+            }
+            for i in range(40)
+        ]
+
+    def test_matches_serial_order_and_results(self):
+        serial = list(evaluate_jobs(self.jobs, self.NOW, RuleCache()))
+        parallel = list(
+            evaluate_jobs_parallel(self.jobs, 3, self.NOW, RuleCache(), chunk_size=7)
+        )
+
+        self.assertEqual(parallel, serial)
+        self.assertEqual({d["status"] for d in serial}, {0, 1, -1})
+
+    def test_worker_metrics_are_merged(self):
+        self.addCleanup(disable_metrics)
+        serial = enable_metrics()
+        list(evaluate_jobs(self.jobs, self.NOW, RuleCache()))
+        parallel = enable_metrics()
+        list(evaluate_jobs_parallel(self.jobs, 2, self.NOW, chunk_size=7))
+
+        self.assertEqual(parallel.counters["jobs_evaluated"], 40)
+        self.assertEqual(parallel.counters["checks"], serial.counters["checks"])
+        self.assertEqual(
+            parallel.counters["simple_jobs"], serial.counters["simple_jobs"]
+        )
+        self.assertEqual(parallel.phases["check"].count, serial.phases["check"].count)
+
+    def test_run_jobs_file_with_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "jobs.jsonl")
+            with open(path, "w") as f:
+                f.writelines(json.dumps(job) + "\n" for job in self.jobs)
+            out = io.StringIO()
+            with patch("scheduler.datetime") as mock_datetime:
+                mock_datetime.now.return_value = self.NOW
+                mock_datetime.fromisoformat.side_effect = datetime.fromisoformat
+                run_jobs_file(path, out=out, cache=RuleCache(), workers=2)
+
+        decisions = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(
+            decisions, list(evaluate_jobs(self.jobs, self.NOW, RuleCache()))
+        )
+
+
+class TestSharding(unittest.TestCase):
+    NOW = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+    RULE = "DTSTART:20241026T000000Z RRULE:FREQ=MINUTELY;INTERVAL=20"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.manifest = os.path.join(self.tmpdir.name, "jobs.jsonl")
+        with open(self.manifest, "w") as f:
+            for i in range(30):
+                job = {"job_id": f"job-{i}", "include_rule": self.RULE}
+                f.write(json.dumps(job) + "\n")
+
+    def run_shard(self, shard, now_utc=None, name="shard"):
+        path = os.path.join(self.tmpdir.name, "%s-%d-of-%d.jsonl" % (name, *shard))
+        with open(path, "w") as out, patch("scheduler.datetime") as mock_datetime:
+            mock_datetime.now.return_value = now_utc or self.NOW
+            mock_datetime.fromisoformat.side_effect = datetime.fromisoformat
+            run_jobs_file(self.manifest, out=out, cache=RuleCache(), shard=shard)
+        return path
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard("3/8"), (3, 8))
+        for spec in ("8/8", "-1/8", "3", "a/b", "1/0"):
+            with self.subTest(spec=spec):
+                with self.assertRaises(ValueError):
+                    parse_shard(spec)
+
+    def test_partition_is_balanced_and_complete(self):
+        job_ids = [f"job-{i}" for i in range(1000)]
+        jobs = [{"job_id": job_id} for job_id in job_ids]
+        shards = [
+            [job["job_id"] for job in select_shard(jobs, (i, 4))] for i in range(4)
+        ]
+
+        self.assertEqual(sorted(sum(shards, [])), sorted(job_ids))
+        for shard in shards:
+            self.assertGreater(len(shard), 180)
+
+    def test_adding_a_shard_only_moves_jobs_to_it(self):
+        for i in range(1000):
+            before, after = shard_of(f"job-{i}", 4), shard_of(f"job-{i}", 5)
+            self.assertIn(after, (before, 4))
+
+    def test_merge_restores_every_decision(self):
+        paths = [self.run_shard((i, 3)) for i in range(3)]
+        out = io.StringIO()
+
+        merged = merge_shards(reversed(paths), out)
+
+        decisions = [json.loads(line) for line in out.getvalue().splitlines()]
+        with patch("scheduler.datetime") as mock_datetime:
+            mock_datetime.now.return_value = self.NOW
+            expected = list(
+                evaluate_jobs(load_jobs(self.manifest), self.NOW, RuleCache())
+            )
+        self.assertEqual(merged, 30)
+        self.assertEqual(
+            sorted(decisions, key=lambda d: d["job_id"]),
+            sorted(expected, key=lambda d: d["job_id"]),
+        )
+
+    def test_empty_shard_is_not_missing(self):
+        # With far more shards than jobs, some shards get none at all
+        paths = [self.run_shard((i, 40)) for i in range(40)]
+
+        self.assertEqual(merge_shards(paths, io.StringIO()), 30)
+
+    def test_missing_duplicate_and_mismatched_shards(self):
+        first, second, third = (self.run_shard((i, 3)) for i in range(3))
+        later = self.run_shard((2, 3), self.NOW + timedelta(hours=1), "later")
+        other_split = self.run_shard((2, 4))
+        truncated = os.path.join(self.tmpdir.name, "truncated.jsonl")
+        with open(third) as f, open(truncated, "w") as out:
+            out.writelines(f.readlines()[1:])
+
+        cases = {
+            r"missing shard\(s\) 1/3": [first, third],
+            "duplicate shard 0/3": [first, second, third, first],
+            "different slots": [first, second, later],
+            "different splits": [first, second, third, other_split],
+            "decisions": [first, second, truncated],
+        }
+        for message, paths in cases.items():
+            with self.subTest(message=message):
+                with self.assertRaisesRegex(ShardMergeError, message):
+                    merge_shards(paths, io.StringIO())
+
+
+class TestOccurrenceStore(unittest.TestCase):
+    NOW = datetime(2024, 10, 28, 10, 5, tzinfo=UTC)
+    RULE = "DTSTART:20241028T000000Z RRULE:FREQ=HOURLY;BYMINUTE=15"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.store = OccurrenceStore(self.tmpdir.name)
+
+    def check(self, now_utc, rule=None, exdates=None, store=None):
+        # A fresh cache per check, like a new CLI process
+        return check_rrule_in_slot(
+            rule or self.RULE,
+            None,
+            exdates,
+            now_utc=now_utc,
+            cache=RuleCache(horizon=timedelta(days=1)),
+            store=store or self.store,
+        )
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.tmpdir.name))
+
+    def test_hit_skips_rule_evaluation(self):
+        self.assertEqual(self.check(self.NOW), 0)
+        self.assertEqual(len(self.files()), 1)
+
+        with patch("dateutil.rrule.rrulestr", side_effect=AssertionError("parsed")):
+            self.assertEqual(self.check(self.NOW), 0)
+            self.assertEqual(self.check(self.NOW + timedelta(minutes=15)), 1)
+            self.assertEqual(self.check(self.NOW + timedelta(hours=5)), 0)
+
+    def test_hit_without_write_access(self):
+        self.assertEqual(self.check(self.NOW), 0)
+
+        with patch("dateutil.rrule.rrulestr", side_effect=AssertionError("parsed")):
+            with patch("scheduler.os.utime", side_effect=PermissionError):
+                self.assertEqual(self.check(self.NOW), 0)
+
+    def test_matches_uncached_checks(self):
+        for minutes in range(0, 24 * 60, 25):
+            now_utc = self.NOW + timedelta(minutes=minutes)
+            with self.subTest(now_utc=now_utc):
+                expected = check_rrule_in_slot(
+                    self.RULE, now_utc=now_utc, cache=RuleCache()
+                )
+                self.assertEqual(self.check(now_utc), expected)
+
+    def test_window_outside_horizon_is_recomputed(self):
+        self.check(self.NOW)
+        key = self.store.key(self.RULE)
+
+        self.assertEqual(self.store.lookup(key, 1730282700, 1730284200), (False, None))
+        self.assertEqual(self.check(self.NOW + timedelta(days=2)), 0)
+        self.assertEqual(self.store.lookup(key, 1730282700, 1730284200)[0], True)
+
+    def test_inputs_are_normalized_into_the_key(self):
+        exdate = datetime(2024, 10, 28, 10, 15, tzinfo=UTC)
+        spaced = "DTSTART:20241028T000000Z\n  RRULE:FREQ=HOURLY;BYMINUTE=15"
+        zurich = exdate.astimezone(tz.gettz("Europe/Zurich"))
+
+        self.assertEqual(self.store.key(self.RULE), self.store.key(spaced))
+        self.assertEqual(
+            self.store.key(self.RULE, None, [exdate]),
+            self.store.key(self.RULE, None, [zurich]),
+        )
+        self.assertNotEqual(
+            self.store.key(self.RULE), self.store.key(self.RULE, None, [exdate])
+        )
+        self.assertEqual(self.check(self.NOW, exdates=[exdate]), 1)
+        self.assertEqual(self.check(self.NOW), 0)
+
+    def test_calendar_contents_are_part_of_the_key(self):
+        before = ExclusionCalendar("holidays", [])
+        after = ExclusionCalendar("holidays", [self.NOW])
+
+        self.assertNotEqual(
+            self.store.key(self.RULE, calendars=[before]),
+            self.store.key(self.RULE, calendars=[after]),
+        )
+
+    def test_corrupt_file_is_a_miss(self):
+        self.check(self.NOW)
+        (name,) = self.files()
+        for content in (b"", b"garbage", b"SLOTOCCX" + bytes(24)):
+            with self.subTest(content=content):
+                with open(os.path.join(self.tmpdir.name, name), "wb") as f:
+                    f.write(content)
+                self.assertEqual(
+                    self.store.lookup(name[:-4], 1730109900, 1730111400), (False, None)
+                )
+                self.assertEqual(self.check(self.NOW), 0)
+
+    def test_eviction_keeps_the_most_recently_used(self):
+        rules = [
+            f"DTSTART:20241028T000000Z RRULE:FREQ=HOURLY;BYMINUTE={minute}"
+            for minute in (10, 20, 30)
+        ]
+        for i, rule in enumerate(rules):
+            self.check(self.NOW, rule)
+            path = self.store.path(self.store.key(rule))
+            os.utime(path, (1000 + i, 1000 + i))
+        self.check(self.NOW, rules[0])
+        size = os.path.getsize(self.store.path(self.store.key(rules[0])))
+
+        store = OccurrenceStore(self.tmpdir.name, max_bytes=2 * size)
+        self.check(self.NOW, rules[2], store=store)
+        store.evict()
+
+        kept = {store.path(store.key(rule)) for rule in rules[::2]}
+        self.assertEqual(
+            {os.path.join(self.tmpdir.name, name) for name in self.files()}, kept
+        )
+
+    def test_directory_is_scanned_on_a_sample_of_writes(self):
+        rule = "DTSTART:20241028T000000Z RRULE:FREQ=HOURLY"
+        compiled = CompiledRule(compile_rules(rule))
+        index = compiled.index
+        index.ensure(self.NOW, int(self.NOW.timestamp()) + 3600)
+        key = self.store.key(rule)
+
+        with patch.object(self.store, "evict") as evict:
+            for _ in range(100):
+                self.store.save(key, index)
+        self.assertLess(evict.call_count, 5)
+
+        store = OccurrenceStore(self.tmpdir.name, max_bytes=1)
+        with patch.object(store, "evict") as evict:
+            store.save(key, index)
+        evict.assert_called_once_with()
+
+
+class TestStartup(unittest.TestCase):
+    HERE = os.path.dirname(os.path.abspath(__file__))
+
+    def run_python(self, code):
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=self.HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result.stdout.split()
+
+    def test_import_is_lean(self):
+        loaded = self.run_python(
+            "import logging, sys, scheduler\n"
+            "heavy = ('argparse', 'asyncio', 'dateutil.rrule', 'numpy')\n"
+            "print(*[m for m in heavy if m in sys.modules])\n"
+            "print('handlers', len(logging.getLogger().handlers))"
+        )
+
+        self.assertEqual(loaded, ["handlers", "0"])
+
+    def test_cached_check_does_not_load_dateutil_rules(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            code = (
+                "import sys, scheduler\n"
+                "sys.argv = ['scheduler.py', '--include-rule', "
+                "'DTSTART:20240101T000000Z RRULE:FREQ=SECONDLY', "
+                f"'--cache-dir', {tmp!r}, '--index-horizon-hours', '1', "
+                "'--log-level', 'ERROR']\n"
+                "try:\n"
+                "    scheduler.main()\n"
+                "except SystemExit as e:\n"
+                "    print(e.code, 'dateutil.rrule' in sys.modules)"
+            )
+
+            self.assertEqual(self.run_python(code), ["0", "True"])
+            self.assertEqual(self.run_python(code), ["0", "False"])
+
+    def test_frequency_numbers_match_dateutil(self):
+        import scheduler
+        from dateutil import rrule
+
+        for name in ("WEEKLY", "DAILY", "HOURLY", "MINUTELY", "SECONDLY"):
+            self.assertEqual(getattr(scheduler, name), getattr(rrule, name))
+
+
+class TestJobRegistry(unittest.TestCase):
+    RULE = "DTSTART;TZID=Europe/Zurich:20241020T080000 RRULE:FREQ=HOURLY;BYMINUTE=0,40"
+    EXRULE = "DTSTART;TZID=Europe/Zurich:20241020T080000 RRULE:FREQ=DAILY;BYHOUR=12"
+    NOW = datetime(2024, 10, 26, 6, 0, tzinfo=UTC)
+
+    def setUp(self):
+        self.cache = RuleCache(horizon=timedelta(days=1))
+        self.registry = JobRegistry(self.cache)
+
+    def test_jobs_share_one_compiled_rule(self):
+        for i in range(1000):
+            exdates = [self.NOW + timedelta(hours=i)]
+            self.registry.add(f"job-{i}", self.RULE, None, exdates)
+
+        records = [self.registry[f"job-{i}"] for i in range(1000)]
+        footprint = self.registry.footprint()
+
+        self.assertEqual(len({id(record.rules) for record in records}), 1)
+        self.assertEqual(len(self.cache), 1)
+        self.assertFalse(hasattr(records[0], "__dict__"))
+        self.assertEqual(list(records[3].exdates), [int(self.NOW.timestamp()) + 10800])
+        self.assertEqual((footprint["jobs"], footprint["rules"]), (1000, 1))
+        self.assertLess(footprint["bytes_per_job"], 512)
+
+    def test_matches_check_rrule_in_slot(self):
+        holidays = ExclusionCalendar("holidays", [datetime(2024, 10, 26, 8, 40)])
+        jobs = {
+            "plain": (self.RULE, None, [], ()),
+            "exrule": (self.RULE, self.EXRULE, [], ()),
+            "exdates": (
+                self.RULE,
+                None,
+                [datetime(2024, 10, 26, 7, 0, tzinfo=tz.gettz("Europe/Zurich"))],
+                (),
+            ),
+            "calendar": (self.RULE, self.EXRULE, [], (holidays,)),
+        }
+        for job_id, (rule, exrule, exdates, job_calendars) in jobs.items():
+            self.registry.add(job_id, rule, exrule, exdates, job_calendars)
+
+        for minutes in range(0, 12 * 60, 20):
+            now_utc = self.NOW + timedelta(minutes=minutes)
+            for job_id, (rule, exrule, exdates, job_calendars) in jobs.items():
+                with self.subTest(now_utc=now_utc, job_id=job_id):
+                    self.assertEqual(
+                        self.registry.check(job_id, now_utc),
+                        check_rrule_in_slot(
+                            rule,
+                            exrule,
+                            exdates,
+                            now_utc=now_utc,
+                            cache=RuleCache(),
+                            calendars=job_calendars,
+                        ),
+                    )
+
+    def test_shared_rule_is_released_with_its_last_job(self):
+        self.registry.add("a", self.RULE)
+        self.registry.add("b", self.RULE)
+        self.registry.add("b", self.RULE, self.EXRULE)
+
+        self.assertEqual(self.registry.footprint()["rules"], 2)
+        self.assertTrue(self.registry.remove("a"))
+        self.assertFalse(self.registry.remove("a"))
+        self.assertEqual(self.registry.footprint()["rules"], 1)
+
+    def test_invalid_rule_keeps_previous_registration(self):
+        self.registry.add("a", self.RULE)
+
+        with self.assertRaises(ValueError):
+            self.registry.add("a", "garbage")
+
+        self.assertEqual(self.registry["a"].rules, (self.RULE, None))
+
+    def test_full_ruleset_on_demand(self):
+        self.registry.add("a", self.RULE, None, [self.NOW])
+
+        rules = self.registry.ruleset("a")
+
+        self.assertEqual(
+            rules.after(self.NOW, inc=True), datetime(2024, 10, 26, 6, 40, tzinfo=UTC)
+        )
+
+
+class TestZoneTable(unittest.TestCase):
+    def assertMatchesDateutil(self, zone, start, hours):
+        local = start
+        while local < start + timedelta(hours=hours):
+            occurrence = local.replace(tzinfo=zone)
+            self.assertEqual(utc_timestamp(occurrence), occurrence.timestamp(), local)
+            local += timedelta(minutes=15)
+
+    def test_fall_back_keeps_the_earlier_offset(self):
+        zurich = tz.gettz("Europe/Zurich")
+        # 02:00-03:00 happens twice on 27th October 2024; fold=0 is the CEST one
+        self.assertMatchesDateutil(zurich, datetime(2024, 10, 26, 22), 8)
+        self.assertEqual(
+            utc_timestamp(datetime(2024, 10, 27, 2, 30, tzinfo=zurich)),
+            datetime(2024, 10, 27, 0, 30, tzinfo=UTC).timestamp(),
+        )
+
+    def test_spring_forward_gap(self):
+        # 02:00-03:00 does not exist on 31st March 2024 in Europe/Zurich
+        self.assertMatchesDateutil(
+            tz.gettz("Europe/Zurich"), datetime(2024, 3, 30, 22), 8
+        )
+
+    def test_half_hour_transitions(self):
+        lord_howe = tz.gettz("Australia/Lord_Howe")
+        self.assertMatchesDateutil(lord_howe, datetime(2024, 4, 6, 22), 6)
+        self.assertMatchesDateutil(lord_howe, datetime(2024, 10, 5, 22), 6)
+
+    def test_lookups_outside_the_window_retabulate(self):
+        new_york = tz.gettz("America/New_York")
+        self.assertMatchesDateutil(new_york, datetime(2024, 11, 2, 22), 8)
+        self.assertMatchesDateutil(new_york, datetime(2031, 3, 8, 22), 8)
+        self.assertMatchesDateutil(new_york, datetime(2050, 3, 12, 22), 8)
+
+    def test_misplaced_transition_falls_back_to_dateutil(self):
+        # dateutil's astimezone() puts Casablanca's 2037-10-04 transition an hour
+        # late, with the same offset either side of it
+        casablanca = tz.gettz("Africa/Casablanca")
+        local = datetime(2038, 1, 1) - datetime(1970, 1, 1)
+        zone_table(casablanca).build(int(local.total_seconds()))
+
+        occurrence = datetime(2037, 7, 25, 20, 5, tzinfo=casablanca)
+        self.assertEqual(utc_timestamp(occurrence), occurrence.timestamp())
+        self.assertMatchesDateutil(casablanca, datetime(2037, 10, 3, 22), 8)
+
+    def test_table_is_shared_per_zone(self):
+        rule = "DTSTART;TZID=Europe/Zurich:20240101T090000 RRULE:FREQ=DAILY"
+        exrule = "DTSTART;TZID=Europe/Zurich:20240101T090000 RRULE:FREQ=WEEKLY"
+        first = rrulestr(rule)._dtstart
+        second = rrulestr(exrule)._dtstart
+        self.assertIs(zone_table(first.tzinfo), zone_table(second.tzinfo))
+        self.assertIsNone(zone_table(UTC))
+        self.assertIsNone(zone_table(tz.tzoffset(None, 3600)))
+
+    def test_zones_without_tables_are_not_kept(self):
+        tables = len(zone_tables)
+        for hour in range(100):
+            rule = f"DTSTART:20240101T{hour % 24:02}0000Z RRULE:FREQ=DAILY;COUNT={hour + 1}"
+            for occurrence in rrulestr(rule):
+                self.assertEqual(utc_timestamp(occurrence), occurrence.timestamp())
+            utc_timestamp(datetime(2024, 1, 1, tzinfo=tz.tzoffset(None, hour * 60)))
+
+        self.assertEqual(len(zone_tables), tables)
+
+
 if __name__ == "__main__":
     unittest.main()